@@ -0,0 +1,202 @@
+"""Async front end for SQLManager. The bot's commands run on an event loop, so every database call is handed off to a
+thread pool sized to match the connection pool. That way a slow query only holds up the command that made it."""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from interactions import User
+
+from Cache import TTLCache
+from CommandTracer import stage
+from SQLManager import SQLManager
+from WriteBehindQueue import WriteBehindQueue
+
+
+class AsyncSQLManager:
+
+    def __init__(self, pool_size: int = None, write_behind: bool = None, lazy: bool = None):
+        """
+        :param pool_size: Maximum number of open connections (and worker threads). Defaults to SQL_POOL_SIZE from
+        the .env, or 5.
+        :param lazy: Whether to wait for the first query before connecting. See SQLManager.
+        :param write_behind: If True, add_nomination and updateUser are queued up and written in batches. Defaults to
+        SQL_WRITE_BEHIND from the .env, or off.
+        """
+        if pool_size is None:
+            pool_size = int(os.getenv("SQL_POOL_SIZE", 5))
+        if write_behind is None:
+            write_behind = os.getenv("SQL_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+
+        # The blocking manager, for use outside the event loop (e.g. at startup)
+        self.sync = SQLManager(pool_size, lazy=lazy)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sql")
+
+        # Recent get_nomination results, keyed by their filters. Lots of people run the same listing during voting, so
+        # identical queries share one trip to the database and then a few seconds of cache.
+        self._nomination_results = TTLCache(max_size=int(os.getenv("SQL_NOMINATION_CACHE_SIZE", 1024)),
+                                            ttl=float(os.getenv("SQL_NOMINATION_CACHE_TTL", 5)))
+        self._nomination_queries = {}  # Filters -> future for queries in flight
+        self._nomination_writes = 0  # Goes up on every invalidation, so a query that raced one isn't cached
+
+        self._write_queues = {}
+        self._queued_nominations = set()  # (guildID, messageID, category) of nominations waiting in the queue
+        if write_behind:
+            settings = {
+                "max_batch": int(os.getenv("SQL_WRITE_BEHIND_BATCH", 100)),
+                "interval": int(os.getenv("SQL_WRITE_BEHIND_INTERVAL_MS", 50)) / 1000,
+                "max_pending": int(os.getenv("SQL_WRITE_BEHIND_MAX_PENDING", 1000)),
+            }
+            self._write_queues["nominations"] = WriteBehindQueue(
+                lambda rows: self.run(self.sync.add_nominations, rows), **settings)
+            self._write_queues["users"] = WriteBehindQueue(self._flush_users, **settings)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs a blocking function on the database thread pool.
+        :return: Whatever func returns
+        """
+        loop = asyncio.get_running_loop()
+        with stage("db"):
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        """
+        Any SQLManager method can be awaited straight off of this class, e.g. `await database.get_wallet(userID)`.
+        """
+        attribute = getattr(self.sync, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        async def wrapper(*args, **kwargs):
+            return await self.run(attribute, *args, **kwargs)
+
+        return wrapper
+
+    async def get_nomination(self, author_id=None, category: str = None, guild_id: int = None,
+                             channel_id: int = None, message_id: int = None, after_id: int = None,
+                             limit: int = None, fields: tuple[str, ...] = None) -> list[tuple]:
+        """
+        Same as SQLManager.get_nomination. Results are cached for a few seconds, and callers asking for the same
+        nominations at the same time share a single query.
+        """
+        if isinstance(author_id, User):
+            author_id = author_id.id
+        key = tuple(None if value is None else int(value)
+                    for value in (author_id, guild_id, channel_id, message_id, after_id, limit)) + \
+            (category, None if fields is None else tuple(fields))
+
+        rows = self._nomination_results.get(key)
+        if rows is not None:
+            return list(rows)
+
+        future = self._nomination_queries.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._query_nominations(key))
+            self._nomination_queries[key] = future
+
+            def forget(done):
+                if self._nomination_queries.get(key) is done:  # It may have been invalidated and replaced already
+                    del self._nomination_queries[key]
+            future.add_done_callback(forget)
+        return list(await asyncio.shield(future))
+
+    async def _query_nominations(self, key: tuple) -> list[tuple]:
+        author_id, guild_id, channel_id, message_id, after_id, limit, category, fields = key
+        writes = self._nomination_writes
+        rows = await self.run(self.sync.get_nomination, author_id, category, guild_id, channel_id, message_id,
+                              after_id, limit, fields)
+        if writes == self._nomination_writes:  # Otherwise a nomination was added since, and this might not have it
+            self._nomination_results.set(key, rows)
+        return rows
+
+    def invalidate_nominations(self, guildID: int = None, category: str = None):
+        """
+        Forgets cached get_nomination results that a new nomination could change.
+        :param guildID: Guild the nomination was made in. None forgets every guild.
+        :param category: Category it was made for. None forgets every category.
+        """
+        def affected(key: tuple) -> bool:
+            key_guild, key_category = key[1], key[6]
+            return (guildID is None or key_guild is None or key_guild == int(guildID)) and \
+                (category is None or key_category is None or key_category == category)
+
+        self._nomination_writes += 1
+        self._nomination_results.invalidate_where(affected)
+        for key in [key for key in self._nomination_queries if affected(key)]:
+            del self._nomination_queries[key]  # Anyone asking from now on gets a fresh query
+
+    async def _flush_users(self, users: list) -> bool:
+        return await self.run(self.sync.sync_users, users) >= 0
+
+    async def add_nomination(self, authorID: int, guildID: int, channelID: int, category: str,
+                             messageID: int, message: str = None) -> bool:
+        """
+        Same as SQLManager.add_nomination. In write-behind mode the nomination shares a commit with any others made
+        around the same time, but this still only returns once it's saved.
+        :return: True if successful, False otherwise, -1 if the message is already nominated for the category
+        """
+        queue = self._write_queues.get("nominations")
+        if queue is None:
+            result = await self.run(self.sync.add_nomination, authorID, guildID, channelID, category, messageID,
+                                    message)
+        else:
+            # Duplicates are turned away before they're queued, including ones already waiting in the queue
+            key = (int(guildID), int(messageID), category)
+            if key in self._queued_nominations or self.sync.is_nominated(*key):
+                return -1
+            self._queued_nominations.add(key)
+            try:
+                result = await queue.submit((authorID, guildID, channelID, category, messageID, message))
+            finally:
+                self._queued_nominations.discard(key)
+
+        if result is True:
+            self.invalidate_nominations(guildID, category)
+        return result
+
+    async def updateUser(self, user):
+        """Same as SQLManager.updateUser, batched with other updates in write-behind mode."""
+        queue = self._write_queues.get("users")
+        if queue is None:
+            return await self.run(self.sync.updateUser, user)
+        await queue.submit(user)
+
+    async def flush(self):
+        """Waits until every queued write is saved. Does nothing outside of write-behind mode."""
+        await asyncio.gather(*(queue.flush() for queue in self._write_queues.values()))
+
+    def stats(self) -> dict:
+        """:return: Connection pool and cache statistics, plus how many calls are queued up for a worker thread"""
+        stats = self.sync.pool_stats()
+        stats["queued"] = self._executor._work_queue.qsize()
+        stats.update(self.sync.cache_stats())
+        stats.update({"nomination_cache_size": len(self._nomination_results),
+                      "nomination_cache_hits": self._nomination_results.hits,
+                      "nomination_cache_misses": self._nomination_results.misses})
+        for name, queue in self._write_queues.items():
+            stats[f"write_behind_{name}"] = queue.stats()
+        return stats
+
+    def health(self) -> dict:
+        """:return: Whether the database can be reached. Doesn't touch the database, so it's safe to call anywhere."""
+        health = self.sync.health()
+        health["backend"] = self.sync.backend.name
+        return health
+
+    def is_closed(self) -> bool:
+        return self.sync.is_closed()
+
+    async def shutdown(self):
+        """Writes everything still queued, then closes every connection"""
+        await asyncio.gather(*(queue.close() for queue in self._write_queues.values()))
+        self.close()
+
+    def close(self):
+        """
+        Closes every connection. Queries that are already running finish first, then their connections close.
+        Use shutdown() instead in write-behind mode, or queued writes are lost.
+        """
+        self._executor.shutdown(wait=False)
+        self.sync.close()
@@ -0,0 +1,120 @@
+"""Keeps the list of award categories in memory, indexed so the bot can check a name or autocomplete a prefix without
+scanning the whole list. The list can be reloaded from the database at any time without restarting the bot.
+
+Every successful reload is also written to a snapshot file, which is what the bot starts up from. That way startup
+never has to wait on the database, and the categories are still there if the database is down."""
+import asyncio
+import json
+import os
+from bisect import bisect_left
+from typing import Any, Callable
+
+
+class CategoryRegistry:
+
+    def __init__(self, names=(), snapshot_path: str = None):
+        """
+        :param names: Starting category names
+        :param snapshot_path: File the categories are saved to after every reload. None turns snapshots off.
+        """
+        self._index = {}  # Normalized name -> name as it's stored in the database
+        self._keys = []  # Normalized names, sorted so every name with a given prefix sits next to each other
+        self.snapshot_path = snapshot_path
+        self.replace(names)
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        """Lowercases a name and collapses its whitespace, so "worst  idea" and "Worst Idea" match"""
+        return " ".join(name.casefold().split())
+
+    def replace(self, names):
+        """Swaps in a new set of categories"""
+        index = {self.normalize(name): name for name in names}
+        # Swapped in one go so a command running in between never sees half of each list
+        self._index, self._keys = index, sorted(index)
+
+    def lookup(self, name: str) -> str | None:
+        """
+        :param name: Category name typed by a user, in any case
+        :return: The category's name as it's stored in the database, or None if there's no such category
+        """
+        return self._index.get(self.normalize(name))
+
+    def complete(self, prefix: str, limit: int = 25) -> list[str]:
+        """
+        :param prefix: What the user has typed so far
+        :param limit: Most suggestions to return. Discord shows 25 at most.
+        :return: Category names starting with prefix, in alphabetical order
+        """
+        prefix = self.normalize(prefix)
+        keys = self._keys
+        matches = []
+
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(matches) < limit and keys[i].startswith(prefix):
+            matches.append(self._index[keys[i]])
+            i += 1
+        return matches
+
+    def __contains__(self, name: str) -> bool:
+        return self.lookup(name) is not None
+
+    def __iter__(self):
+        return iter(self._index.values())
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    async def reload(self, database) -> bool:
+        """
+        Reloads the categories from the database.
+        :param database: AsyncSQLManager to read the categories table from
+        :return: True if successful, False if the database couldn't be read (the old categories are kept)
+        """
+        try:
+            rows = await database.get_categories()
+        except Exception as e:
+            print(f"Error reloading categories: {e}")
+            return False
+
+        self.replace(row.name for row in rows)
+        self.save_snapshot()
+        return True
+
+    async def auto_reload(self, get_database: Callable[[], Any], interval: float):
+        """
+        Reloads the categories right away, then every interval seconds, forever. Meant to be run as a background task.
+        :param get_database: Returns the AsyncSQLManager to read from. Called before every reload, so a database that's
+        been replaced since (e.g. by /admin restart_connection) is picked up.
+        """
+        while True:
+            await self.reload(get_database())
+            await asyncio.sleep(interval)
+
+    def load_snapshot(self) -> bool:
+        """
+        Loads the categories saved by the last successful reload.
+        :return: True if successful, False if there's no snapshot or it couldn't be read
+        """
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as file:
+                self.replace(json.load(file))
+        except (OSError, ValueError) as e:
+            print(f"Error reading category snapshot {self.snapshot_path}: {e}")
+            return False
+        return True
+
+    def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        try:
+            # Write to a temporary file first, so a crash halfway through never leaves a broken snapshot behind.
+            # It's named after the process, since every shard saves the same snapshot.
+            temporary = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(list(self), file)
+            os.replace(temporary, self.snapshot_path)
+        except OSError as e:
+            print(f"Error writing category snapshot {self.snapshot_path}: {e}")
@@ -0,0 +1,195 @@
+"""Times every command, broken down into stages (database, Discord API lookups, rendering, sending), and defers the
+interaction if the command is about to blow through Discord's 3 second deadline. A slow database turns into a
+"Nakamoto is thinking..." followed by the real reply, instead of "This interaction failed".
+
+Wrap a command's coroutine with @traced(), and mark stages anywhere below it with `with stage("db"):`. Each finished
+command prints one JSON line starting with TRACE.
+
+A watched context's reply methods (send, send_modal, edit_origin) take turns with the defer, so a reply and a defer
+never both go out for the same interaction, however the reply is sent."""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import time
+from contextlib import contextmanager, asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()  # This is imported before anything else that loads the .env, and reads it right away
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# How long a command can go without responding before it gets deferred. Leaves room under Discord's 3 seconds for
+# the defer itself to get there.
+DEFAULT_BUDGET = int(os.getenv("COMMAND_DEFER_BUDGET_MS", 2000)) / 1000
+
+
+class Trace:
+
+    def __init__(self, command: str):
+        self.command = command
+        self.start = time.perf_counter()
+        self.stages = {}  # Stage name -> seconds spent in it
+        self.deferred = []  # Seconds in when each watched context was deferred
+        self.error = None
+        self._watchers = []  # Tasks waiting to defer a context
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        total = time.perf_counter() - self.start
+        return {
+            "command": self.command,
+            "total_ms": round(total * 1000, 2),
+            "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            "deferred_at_ms": [round(seconds * 1000, 2) for seconds in self.deferred],
+            "error": self.error,
+        }
+
+
+def current_trace() -> Trace | None:
+    """:return: The trace of the command running right now, if any"""
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Adds the time spent in a with block to the current command's trace. Does nothing outside of a traced command.
+    :param name: Stage to add it to, e.g. db, api, render or send
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+# Context methods that answer the interaction, and so have to take turns with a defer
+_REPLIES = ("send", "respond", "send_modal", "edit_origin")
+
+
+class _ReplyGuard:
+    """Lets one reply or defer through to a context at a time. A reply that calls another reply method goes straight
+    through, instead of waiting on itself."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner = None  # Task holding the lock
+
+    @asynccontextmanager
+    async def hold(self):
+        task = asyncio.current_task()
+        if self._owner is task:
+            yield
+            return
+        async with self._lock:
+            self._owner = task
+            try:
+                yield
+            finally:
+                self._owner = None
+
+
+def _guard(ctx) -> _ReplyGuard:
+    """:return: The context's reply guard. The first call wraps its reply methods to go through it."""
+    guard = getattr(ctx, "_reply_guard", None)
+    if guard is not None:
+        return guard
+
+    guard = ctx._reply_guard = _ReplyGuard()
+    for name in _REPLIES:
+        method = getattr(ctx, name, None)
+        if method is None:
+            continue
+
+        async def guarded(*args, _method=method, **kwargs):
+            async with guard.hold():
+                return await _method(*args, **kwargs)
+
+        setattr(ctx, name, functools.wraps(method)(guarded))
+    return guard
+
+
+async def _defer_when_late(ctx, guard: _ReplyGuard, trace: Trace, budget: float, ephemeral: bool, edit_origin: bool):
+    await asyncio.sleep(budget)
+
+    # A reply that's already on its way finishes first, and might beat the deadline on its own
+    async with guard.hold():
+        if ctx.responded or ctx.deferred:
+            return
+        try:
+            if edit_origin:
+                await ctx.defer(edit_origin=True)
+            else:
+                await ctx.defer(ephemeral=ephemeral)
+            trace.deferred.append(time.perf_counter() - trace.start)
+        except Exception as e:
+            print(f"Error deferring {trace.command}: {e}")
+
+
+def watch(ctx, budget: float = None, ephemeral: bool = False, edit_origin: bool = False) -> asyncio.Task | None:
+    """
+    Defers ctx if it hasn't been responded to within budget seconds. traced() does this for the command's own
+    context. Call this for follow-up contexts, like the one a modal submission comes back with.
+    :param edit_origin: Defer as an update to the message the context came from (for buttons), instead of as a new
+    "thinking..." reply
+    :return: The task doing the watching. It's cancelled when the command finishes.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+
+    # Guarded before the command carries on, so no reply can slip past the defer
+    guard = _guard(ctx)
+    task = asyncio.create_task(_defer_when_late(ctx, guard, trace, budget or DEFAULT_BUDGET, ephemeral, edit_origin))
+    trace._watchers.append(task)
+    return task
+
+
+def traced(budget: float = None, ephemeral: bool = False):
+    """
+    Decorator for command coroutines. Times the command and defers it if it runs long. Goes underneath
+    @slash_command / @message_context_menu and any @slash_option.
+
+    :param budget: Seconds to wait for a response before deferring. Defaults to COMMAND_DEFER_BUDGET_MS from the .env.
+    :param ephemeral: Whether the deferred ("thinking...") response, and so the eventual reply, is only visible to the
+    user who ran the command
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(ctx, *args, **kwargs):
+            async with tracing(func.__name__, ctx, budget, ephemeral):
+                return await func(ctx, *args, **kwargs)
+
+        return wrapper
+    return decorator
+
+
+@asynccontextmanager
+async def tracing(name: str, ctx, budget: float = None, ephemeral: bool = False, edit_origin: bool = False):
+    """
+    Traces a with block as if it were a command of its own, for work that answers a context outside of the command
+    that created it (e.g. a button press on a message the command sent). Takes the same options as traced() and
+    watch().
+    """
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    watch(ctx, budget, ephemeral, edit_origin)
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = repr(e)
+        raise
+    finally:
+        for watcher in trace._watchers:
+            watcher.cancel()
+        _current_trace.reset(token)
+        print("TRACE " + json.dumps(trace.to_dict()))
@@ -0,0 +1,161 @@
+"""Files complaints posted in the HR channels. Every message the bot sees is checked against the set of HR channels,
+which is all a message anywhere else costs. Complaints go on a WriteBehindQueue, which hands them over in batches: each
+batch is saved with one INSERT, each author gets one acknowledgement, and the complaints are cleared out of each channel
+with one bulk delete, instead of a DM and a delete per message. A batch that can't be saved is queued again a few
+times before its complaints are given up on and left in the channel.
+
+Discord rate limits every route separately (each DM channel, each channel's bulk delete), and interactions.py holds
+requests back until their bucket has room. Acknowledgements go out a few at a time, so a burst keeps several buckets
+busy at once without piling hundreds of requests up behind the global limit."""
+import asyncio
+
+from interactions import Message
+
+from WriteBehindQueue import WriteBehindQueue
+
+ACKNOWLEDGEMENT = "Thank you for the complaint, it has been filed and will be addressed in a timely manner. Your " \
+                  "input means very much to us. You can see the list of complaints [here](" \
+                  "https://docs.google.com/document/d/1wjBOPLrslvETZ3WA2r3dwANrnwkd8oWlAthVFlhQ6cg/edit?usp=sharing)" \
+                  " (updates automatically)."
+
+_BULK_DELETE_LIMIT = 100  # Most messages Discord deletes in one request
+
+
+def parse_channel_ids(value: str) -> frozenset[int]:
+    """:return: The channel IDs in a comma separated list, e.g. from HR_CHANNEL_IDS in the .env"""
+    return frozenset(int(channel) for channel in (value or "").split(",") if channel.strip())
+
+
+class ComplaintIntake:
+
+    def __init__(self, database, channel_ids, max_pending: int = 1000, max_batch: int = 100, interval: float = 1.0,
+                 ack_concurrency: int = 5, max_attempts: int = 3, retry_delay: float = 5.0):
+        """
+        :param database: AsyncSQLManager to save complaints with
+        :param channel_ids: Channels where every message is a complaint
+        :param max_pending: Most complaints that can be waiting at once. Past this, new ones wait for room.
+        :param max_batch: Most complaints handled together
+        :param interval: Longest a complaint waits (in seconds) for more to join its batch
+        :param ack_concurrency: Most acknowledgements being sent at once
+        :param max_attempts: Times a complaint is tried before it's left in the channel
+        :param retry_delay: Seconds to wait before trying a failed complaint again
+        """
+        self.database = database
+        self.channel_ids = frozenset(int(channel) for channel in channel_ids)
+        self.ack_concurrency = ack_concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._writes = WriteBehindQueue(self._file, max_batch, interval, max_pending)
+        self._attempts = {}  # messageID -> failed saves so far, for complaints that are being retried
+        self._retries = set()  # Tasks waiting to queue failed complaints again
+
+        # Statistics
+        self.received = 0
+        self.saved = 0
+        self.failed = 0
+        self.acknowledged = 0
+        self.deleted = 0
+
+    def watches(self, channel_id: int) -> bool:
+        """:return: Whether messages in the channel are complaints"""
+        return channel_id in self.channel_ids
+
+    async def submit(self, message: Message):
+        """Queues a complaint to be filed. Returns as soon as it's queued, unless the queue is full."""
+        self.received += 1
+        await self._writes.put(message)
+
+    async def _file(self, batch: list[Message]) -> bool:
+        rows = [(int(m.guild.id) if m.guild else 0, int(m.channel.id), int(m.id), int(m.author.id), m.content)
+                for m in batch]
+        if not await self.database.add_complaints(rows):
+            self._retry_later(batch)
+            return False
+        for message in batch:
+            self._attempts.pop(int(message.id), None)
+        self.saved += len(batch)
+        print(f"Filed {len(batch)} complaints")
+
+        await asyncio.gather(self._acknowledge(batch), self._delete(batch))
+        return True
+
+    def _retry_later(self, batch: list[Message]):
+        """Queues the complaints of a batch that couldn't be saved again, unless they've run out of attempts"""
+        retry, dropped = [], []
+        for message in batch:
+            attempts = self._attempts.pop(int(message.id), 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[int(message.id)] = attempts
+                retry.append(message)
+            else:
+                dropped.append(message)
+
+        if dropped:
+            # They're left where they are, so they can still be filed by hand
+            self.failed += len(dropped)
+            print(f"Error: couldn't save {len(dropped)} complaints after {self.max_attempts} tries, leaving them in "
+                  f"the channel. Message IDs: {', '.join(str(int(m.id)) for m in dropped)}")
+        if retry:
+            print(f"Error: couldn't save {len(retry)} complaints, trying again in {self.retry_delay}s")
+            task = asyncio.create_task(self._requeue(retry))
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+
+    async def _requeue(self, messages: list[Message]):
+        await asyncio.sleep(self.retry_delay)
+        for message in messages:
+            await self._writes.put(message)
+
+    async def _acknowledge(self, batch: list[Message]):
+        """Thanks every author once, however many complaints they sent"""
+        authors = list({m.author.id: m.author for m in batch}.values())
+        semaphore = asyncio.Semaphore(self.ack_concurrency)
+
+        async def send(author):
+            async with semaphore:
+                try:
+                    await author.send(ACKNOWLEDGEMENT)
+                    self.acknowledged += 1
+                except Exception as e:  # e.g. they don't accept DMs
+                    print(f"Couldn't acknowledge a complaint from {author}: {e}")
+
+        await asyncio.gather(*(send(author) for author in authors))
+
+    async def _delete(self, batch: list[Message]):
+        """Deletes the complaints with one request per channel (per 100 messages)"""
+        channels = {}
+        for message in batch:
+            channels.setdefault(int(message.channel.id), []).append(message)
+
+        for messages in channels.values():
+            channel = messages[0].channel
+            for start in range(0, len(messages), _BULK_DELETE_LIMIT):
+                chunk = messages[start:start + _BULK_DELETE_LIMIT]
+                try:
+                    await channel.delete_messages(chunk, reason="Complaint filed")
+                    self.deleted += len(chunk)
+                except Exception as e:
+                    print(f"Couldn't delete {len(chunk)} filed complaints in {channel}: {e}")
+
+    @property
+    def pending(self) -> int:
+        return self._writes.pending
+
+    async def close(self):
+        """Files every complaint still queued, including ones waiting to be retried, then stops the background task"""
+        await self._writes.flush()
+        while self._retries:
+            await asyncio.gather(*self._retries, return_exceptions=True)
+            await self._writes.flush()
+        await self._writes.close()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "received": self.received,
+            "saved": self.saved,
+            "failed": self.failed,
+            "acknowledged": self.acknowledged,
+            "deleted": self.deleted,
+        }
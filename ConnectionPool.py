@@ -0,0 +1,218 @@
+"""A small bounded connection pool. Each caller checks out its own connection so concurrent commands never share a
+cursor, and the pool keeps track of how long callers had to wait for one.
+
+The pool also keeps its connections healthy. A connection that has sat idle for a while is checked before it's handed
+out (MySQL quietly closes idle connections), dead ones are replaced, and failed connection attempts are retried with
+exponential backoff and jitter."""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Any
+
+
+class ConnectionPool:
+
+    def __init__(self, connect: Callable[[], Any], size: int = 5, timeout: float = 10.0,
+                 ping: Callable[[Any], bool] = None, check_after: float = 30.0,
+                 connect_attempts: int = 4, backoff_base: float = 0.25, backoff_max: float = 5.0):
+        """
+        :param connect: Function that opens a brand-new connection
+        :param size: Maximum number of connections that can be open at once
+        :param timeout: How long (in seconds) a checkout waits for a free connection before giving up
+        :param ping: Function that returns whether a connection is still alive. None skips health checks.
+        :param check_after: Seconds a connection can sit idle before it's pinged on checkout
+        :param connect_attempts: How many times to try opening a connection before giving up
+        :param backoff_base: Seconds to wait after the first failed attempt. Doubles with every failure after that.
+        :param backoff_max: Longest wait between attempts, in seconds
+        """
+        self._connect = connect
+        self._ping = ping
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.connect_attempts = connect_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._idle = []  # (connection, when it was returned) for connections that are open but not checked out
+        self._open = 0  # Number of connections currently open, idle or not
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # Statistics
+        self.checkouts = 0
+        self.waits = 0  # Number of checkouts that had to wait for a connection to be returned
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        # Health
+        self.healthy = True
+        self.last_error = None
+        self.consecutive_failures = 0
+        self.dead_connections = 0  # Connections found dead on checkout or thrown away after an error
+        self.reconnects = 0  # Connections opened to replace dead ones
+
+    def acquire(self):
+        """
+        Checks out a connection, opening a new one if the pool isn't full yet. Blocks until one is free otherwise.
+        :return: An open connection. Give it back with release() when done.
+        """
+        start = time.perf_counter()
+        waited = False
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if self._idle:
+                    cnx, idle_since = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    cnx, idle_since = None, None  # Opened below, outside the lock
+                    break
+
+                waited = True
+                remaining = self.timeout - (time.perf_counter() - start)
+                if remaining <= 0 or not self._condition.wait(remaining):
+                    raise TimeoutError(f"Timed out waiting for a database connection ({self.size} in use)")
+
+        # A connection that's been sitting around might have been closed by the server. Swap it out if so.
+        if cnx is not None and self._ping is not None and time.monotonic() - idle_since > self.check_after:
+            if not self._is_alive(cnx):
+                self._close_quietly(cnx)
+                with self._condition:
+                    self.dead_connections += 1
+                    self.reconnects += 1
+                cnx = None
+
+        if cnx is None:
+            try:
+                cnx = self._open_connection()
+            except Exception:
+                with self._condition:
+                    self._open -= 1
+                    self._condition.notify()
+                raise
+
+        waited_for = time.perf_counter() - start
+        with self._condition:
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            self.total_wait += waited_for
+            self.max_wait = max(self.max_wait, waited_for)
+
+        return cnx
+
+    def _is_alive(self, cnx) -> bool:
+        try:
+            return self._ping(cnx)
+        except Exception:
+            return False
+
+    def _open_connection(self):
+        """Opens a connection, retrying with exponential backoff and jitter if the database can't be reached"""
+        for attempt in range(self.connect_attempts):
+            try:
+                cnx = self._connect()
+            except Exception as e:
+                with self._condition:
+                    self.healthy = False
+                    self.last_error = repr(e)
+                    self.consecutive_failures += 1
+
+                if attempt == self.connect_attempts - 1:
+                    raise
+                # Jitter keeps every thread that lost its connection at once from reconnecting in lockstep
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                print(f"Couldn't connect to the database ({e}), retrying in {delay:.2f}s or so")
+                time.sleep(random.uniform(delay / 2, delay))
+            else:
+                with self._condition:
+                    self.healthy = True
+                    self.consecutive_failures = 0
+                return cnx
+
+    def release(self, cnx, discard: bool = False):
+        """
+        Returns a connection to the pool.
+        :param cnx: Connection that was checked out with acquire()
+        :param discard: If True, the connection is closed instead of reused (for example, after it broke)
+        """
+        with self._condition:
+            if discard or self._closed:
+                self._open -= 1
+                if discard:
+                    self.dead_connections += 1
+            else:
+                self._idle.append((cnx, time.monotonic()))
+            self._condition.notify()
+
+        if discard or self._closed:
+            self._close_quietly(cnx)
+
+    @staticmethod
+    def _close_quietly(cnx):
+        try:
+            cnx.close()
+        except Exception as e:
+            print(f"Error closing pooled connection: {e}")
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of a with block. If the block doesn't finish normally (an error, or
+        a generator closed part way through) the connection is thrown away, since it could be broken or still have
+        unread rows on it.
+        """
+        cnx = self.acquire()
+        try:
+            yield cnx
+        except BaseException:
+            self.release(cnx, discard=True)
+            raise
+        else:
+            self.release(cnx)
+
+    def stats(self) -> dict:
+        """:return: Pool size, usage, and wait-time numbers"""
+        with self._condition:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "total_wait": self.total_wait,
+                "avg_wait": self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def health(self) -> dict:
+        """:return: Whether the database can be reached, and how often connections have had to be replaced"""
+        with self._condition:
+            return {
+                "healthy": self.healthy,
+                "last_error": self.last_error,
+                "consecutive_failures": self.consecutive_failures,
+                "dead_connections": self.dead_connections,
+                "reconnects": self.reconnects,
+            }
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        """Closes every idle connection. Connections still checked out are closed when they come back."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._condition.notify_all()
+
+        for cnx, _ in idle:
+            self._close_quietly(cnx)
@@ -0,0 +1,101 @@
+"""Turns Discord IDs into display names without hammering the API. IDs are deduplicated, looked up in a shared cache,
+and whatever is left is fetched concurrently (up to a limit) instead of one after another."""
+import asyncio
+
+import interactions
+
+from Cache import TTLCache
+from CommandTracer import stage
+
+USER = "user"
+GUILD = "guild"
+CHANNEL = "channel"
+
+
+class EntityResolver:
+
+    def __init__(self, bot: interactions.Client, concurrency: int = 8, ttl: float = 600, max_size: int = 4096):
+        """
+        :param bot: Client used to look entities up
+        :param concurrency: Maximum number of API requests in flight at once
+        :param ttl: Seconds a resolved name is trusted before being fetched again
+        :param max_size: Maximum number of names kept in the cache
+        """
+        self.bot = bot
+        self.cache = TTLCache(max_size=max_size, ttl=ttl)  # (kind, id) -> name
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_flight = {}  # (kind, id) -> future, so concurrent commands share one request per entity
+        self.api_calls = 0
+
+    async def _fetch(self, kind: str, entity_id: int) -> str | None:
+        """Looks the entity up in the client's cache first, then the API. Returns None if it can't be found."""
+        match kind:
+            case "user":
+                entity = self.bot.get_user(entity_id)
+                fetch = self.bot.fetch_user
+            case "guild":
+                entity = self.bot.get_guild(entity_id)
+                fetch = self.bot.fetch_guild
+            case "channel":
+                entity = self.bot.get_channel(entity_id)
+                fetch = self.bot.fetch_channel
+            case _:
+                raise ValueError(f"Unknown entity kind {kind}")
+
+        if entity is None:
+            async with self._semaphore:
+                self.api_calls += 1
+                try:
+                    with stage("api"):
+                        entity = await fetch(entity_id)
+                except Exception as e:
+                    print(f"Error: A {kind} wasn't found when trying to resolve {entity_id}. Full error: {e}")
+                    return None
+
+        if entity is None:
+            return None
+        return entity.display_name if kind == USER else entity.name
+
+    async def _resolve_one(self, kind: str, entity_id: int) -> str:
+        key = (kind, entity_id)
+
+        name = self.cache.get(key)
+        if name is not None:
+            return name
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(kind, entity_id))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        name = await asyncio.shield(future)
+        if name is None:
+            return str(entity_id)  # Not cached, so it gets another try next time
+
+        self.cache.set(key, name)
+        return name
+
+    async def resolve(self, kind: str, ids) -> dict[int, str]:
+        """
+        Resolves a batch of IDs of the same kind. Duplicates are only looked up once.
+
+        :param kind: USER, GUILD or CHANNEL
+        :param ids: IDs to resolve
+        :return: A dict of ID -> name. IDs that couldn't be found map to the ID itself as a string.
+        """
+        unique = list(dict.fromkeys(int(i) for i in ids))
+        names = await asyncio.gather(*(self._resolve_one(kind, i) for i in unique))
+        return dict(zip(unique, names))
+
+    async def resolve_many(self, users=(), guilds=(), channels=()) -> tuple[dict, dict, dict]:
+        """
+        Resolves users, guilds and channels all at once.
+        :return: (user names, guild names, channel names), each a dict of ID -> name
+        """
+        return await asyncio.gather(self.resolve(USER, users), self.resolve(GUILD, guilds),
+                                    self.resolve(CHANNEL, channels))
+
+    def invalidate(self, kind: str, entity_id: int):
+        """Forgets the cached name of an entity, e.g. after it was renamed"""
+        self.cache.invalidate((kind, int(entity_id)))
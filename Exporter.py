@@ -0,0 +1,92 @@
+"""Exports transactions, nominations, wallets and complaints as CSV or JSON Lines, gzipped as they're written. Rows
+are streamed from the database a chunk at a time, so an export takes the same amount of memory no matter how much
+history there is.
+
+Usage:
+    python Exporter.py nominations --format jsonl --output nominations.jsonl.gz
+"""
+import argparse
+import csv
+import datetime
+import decimal
+import gzip
+import io
+import json
+
+from SQLManager import SQLManager, EXPORTABLE_TABLES
+
+FORMATS = ("csv", "jsonl")
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Can't export a {type(value).__name__}")
+
+
+def file_name(table: str, fmt: str, compress: bool = True) -> str:
+    """:return: The name an export of the table should be saved under"""
+    return f"{table}-{datetime.date.today().isoformat()}.{fmt}" + (".gz" if compress else "")
+
+
+def export(database: SQLManager, table: str, fmt: str, file, chunk_size: int = 1000, compress: bool = True) -> int:
+    """
+    Writes a whole table to a file.
+
+    :param database: Database to read from. This blocks, so run it on the database thread pool from the bot.
+    :param table: One of EXPORTABLE_TABLES
+    :param fmt: csv or jsonl
+    :param file: Binary file to write to. Left open.
+    :param chunk_size: Rows read from the database at a time
+    :param compress: Whether to gzip the output
+    :return: Number of rows written
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Can't export as {fmt}. Pick one of: {', '.join(FORMATS)}")
+    columns = EXPORTABLE_TABLES[table]  # Checked again by export_rows, but the header needs it first
+
+    stream = gzip.GzipFile(fileobj=file, mode="wb") if compress else file
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        written = 0
+        if fmt == "csv":
+            writer = csv.writer(text)
+            writer.writerow(columns)
+            for rows in database.export_rows(table, chunk_size):
+                writer.writerows(rows)
+                written += len(rows)
+        else:
+            for rows in database.export_rows(table, chunk_size):
+                text.writelines(json.dumps(dict(zip(columns, row)), default=_json_value) + "\n" for row in rows)
+                written += len(rows)
+    finally:
+        text.flush()
+        text.detach()  # Don't let the wrapper close the caller's file
+        if compress:
+            stream.close()  # Writes the gzip trailer. GzipFile doesn't close a file it was handed.
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("table", choices=list(EXPORTABLE_TABLES))
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", help="File to write to. Defaults to <table>-<date>.<format>.gz")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows read from the database at a time")
+    parser.add_argument("--no-compress", action="store_true", help="Write plain text instead of gzip")
+    args = parser.parse_args()
+
+    output = args.output or file_name(args.table, args.format, not args.no_compress)
+    database = SQLManager(pool_size=1)
+    try:
+        with open(output, "wb") as file:
+            written = export(database, args.table, args.format, file, args.chunk_size, not args.no_compress)
+    finally:
+        database.close()
+    print(f"Exported {written} rows from {args.table} to {output}")
+
+
+if __name__ == "__main__":
+    main()
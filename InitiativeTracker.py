@@ -0,0 +1,161 @@
+"""Tracks initiative rolls for every encounter the bot is running. Each channel in each guild gets its own encounter,
+so tables on different servers never see each other's rolls. Encounters are saved to the database so a restart
+doesn't wipe them."""
+import asyncio
+from bisect import bisect_left, insort
+
+from EntityResolver import EntityResolver, USER
+
+
+class Encounter:
+    """The rolls for a single encounter, always kept in initiative order."""
+
+    def __init__(self):
+        # Sorted list of (-roll, seq, character). seq is when the character first rolled, so ties keep that order
+        self._order = []
+        self._entries = {}  # character -> its entry in _order
+        self._seq = 0
+
+    def set_roll(self, character: int | str, roll: int):
+        """
+        Sets (or replaces) a character's roll.
+        :param character: 18-digit integer for a player's discord ID. If the roll is for an NPC, it will be a string.
+        :param roll: Number that was rolled
+        """
+        entry = self._entries.get(character)
+        if entry is not None:
+            del self._order[bisect_left(self._order, entry)]
+            seq = entry[1]
+        else:
+            seq = self._seq
+            self._seq += 1
+
+        entry = (-roll, seq, character)
+        insort(self._order, entry)
+        self._entries[character] = entry
+
+    def get_roll(self, character: int | str) -> int | None:
+        entry = self._entries.get(character)
+        return -entry[0] if entry is not None else None
+
+    def order(self) -> list[tuple[int | str, int]]:
+        """:return: [(character, roll), ...] from highest roll to lowest"""
+        return [(character, -roll) for roll, _, character in self._order]
+
+    def clear(self):
+        self._order.clear()
+        self._entries.clear()
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+
+class InitiativeTracker:
+
+    def __init__(self, database, resolver: EntityResolver, save_delay: float = 1.0):
+        """
+        :param database: AsyncSQLManager that encounters are saved to
+        :param resolver: Used to turn player IDs into display names
+        :param save_delay: Seconds to wait after a change before saving, so a flurry of rolls is saved once
+        """
+        self.database = database
+        self.resolver = resolver
+        self.save_delay = save_delay
+
+        self._encounters = {}  # (guildID, channelID) -> Encounter
+        self._pending_saves = {}  # (guildID, channelID) -> task that will save the encounter
+        self._cleared_while_loading = None  # Encounters cleared while load() waits on the database
+
+    @staticmethod
+    def _key(guild_id: int | None, channel_id: int) -> tuple[int, int]:
+        return int(guild_id or 0), int(channel_id)  # DMs don't have a guild
+
+    def encounter(self, guild_id: int | None, channel_id: int) -> Encounter:
+        """:return: The encounter running in the given channel, starting a new one if there isn't one yet"""
+        key = self._key(guild_id, channel_id)
+        encounter = self._encounters.get(key)
+        if encounter is None:
+            encounter = self._encounters[key] = Encounter()
+        return encounter
+
+    def set_roll(self, guild_id: int | None, channel_id: int, character: int | str, roll: int):
+        self.encounter(guild_id, channel_id).set_roll(character, roll)
+        self._schedule_save(self._key(guild_id, channel_id))
+
+    def clear(self, guild_id: int | None, channel_id: int):
+        key = self._key(guild_id, channel_id)
+        encounter = self._encounters.pop(key, None)
+        if self._cleared_while_loading is not None:
+            self._cleared_while_loading.add(key)
+        if encounter is not None:
+            self._schedule_save(key)
+
+    async def get_order(self, guild_id: int | None, channel_id: int) -> list[tuple[str, int]]:
+        """
+        :return: The encounter's rolls, sorted. For players, their names will be converted into their native
+        nicknames. For NPC's, their names will be returned as is.
+        """
+        encounter = self._encounters.get(self._key(guild_id, channel_id))
+        if encounter is None:
+            return []
+
+        order = encounter.order()
+        names = await self.resolver.resolve(USER, (c for c, _ in order if isinstance(c, int)))
+        return [(names[c] if isinstance(c, int) else c, roll) for c, roll in order]
+
+    def _schedule_save(self, key: tuple[int, int]):
+        if key not in self._pending_saves:
+            task = self._pending_saves[key] = asyncio.create_task(self._save(key))
+            task.add_done_callback(lambda done: self._log_save_error(key, done))
+
+    @staticmethod
+    def _log_save_error(key: tuple[int, int], task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error saving the initiative order for channel {key[1]}: {task.exception()}")
+
+    async def _save(self, key: tuple[int, int]):
+        await asyncio.sleep(self.save_delay)
+        del self._pending_saves[key]  # Changes from here on get their own save
+
+        encounter = self._encounters.get(key)
+        rolls = encounter.order() if encounter is not None else []
+        if not await self.database.save_encounter(*key, rolls):
+            print(f"Error: couldn't save the initiative order for channel {key[1]}")
+
+    async def flush(self):
+        """Waits for every pending save to finish. Failures are logged as they happen, not raised here."""
+        await asyncio.gather(*self._pending_saves.values(), return_exceptions=True)
+
+    async def load(self, shard_id: int = None, shard_count: int = 1) -> int:
+        """
+        Loads every saved encounter from the database. Rolls and clears made while it loads win over what was saved.
+        :param shard_id: If given, only load encounters in guilds this shard handles
+        :param shard_count: Total number of shards
+        :return: Number of encounters loaded
+        """
+        self._cleared_while_loading = cleared = set()
+        try:
+            rows = await self.database.get_encounters(shard_id, shard_count)
+        finally:
+            self._cleared_while_loading = None
+
+        encounters = {}
+        for guild_id, channel_id, character, roll in rows:
+            key = self._key(guild_id, channel_id)
+            if key not in cleared:
+                encounters.setdefault(key, Encounter()).set_roll(character, roll)
+        loaded = len(encounters)
+
+        # Put the rolls made meanwhile on top, in order, so ties keep the order they were rolled in
+        changed = cleared | self._encounters.keys()
+        for key, encounter in self._encounters.items():
+            merged = encounters.setdefault(key, Encounter())
+            for character, roll in encounter.order():
+                merged.set_roll(character, roll)
+        self._encounters = encounters
+
+        # A save that went out during the load only had the new rolls, so save what they were merged into
+        for key in changed:
+            self._schedule_save(key)
+        return loaded
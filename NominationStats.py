@@ -0,0 +1,203 @@
+"""Nomination counts and leaderboards for every guild, kept in memory. They're built from the database once at startup
+and then counted up as nominations come in, so asking for the top k of anything takes O(k) no matter how many
+nominations there are."""
+
+
+class RankedCounter:
+    """
+    Counts keys and keeps them ranked by count as the counts go up, so the top k can be read off without sorting.
+    Keys with the same count are grouped into a bucket, and the buckets are linked from lowest count to highest.
+    """
+
+    def __init__(self, counts: dict = None):
+        """
+        :param counts: Starting counts, as key -> count
+        """
+        self._counts = {}  # key -> count
+        self._buckets = {}  # count -> keys with that count, in the order they reached it
+        # Links between counts that have a bucket. 0 is a permanent entry below all of them.
+        self._lower = {}
+        self._higher = {0: None}
+        self._top = 0
+        if counts:
+            self._build(counts)
+
+    def _build(self, counts: dict):
+        previous = 0
+        for count in sorted(set(counts.values())):
+            if count <= 0:
+                continue
+            self._buckets[count] = {}
+            self._lower[count] = previous
+            self._higher[previous] = count
+            self._higher[count] = None
+            previous = count
+        self._top = previous
+
+        for key, count in counts.items():
+            if count > 0:
+                self._counts[key] = count
+                self._buckets[count][key] = None
+
+    def increment(self, key):
+        count = self._counts.get(key, 0)
+        new = count + 1
+        self._counts[key] = new
+
+        # Every count that has a bucket is linked in, so the bucket for new (if it exists) is right above count's
+        above = self._higher[count]
+        if above != new:
+            self._buckets[new] = {}
+            self._lower[new] = count
+            self._higher[new] = above
+            self._higher[count] = new
+            if above is None:
+                self._top = new
+            else:
+                self._lower[above] = new
+        self._buckets[new][key] = None
+
+        if count:
+            bucket = self._buckets[count]
+            del bucket[key]
+            if not bucket:  # Unlink it. There's always a bucket above it (new), so it can't be the top.
+                below, above = self._lower.pop(count), self._higher.pop(count)
+                self._higher[below] = above
+                self._lower[above] = below
+                del self._buckets[count]
+
+    def top(self, k: int) -> list[tuple]:
+        """:return: Up to k (key, count) pairs, highest count first"""
+        result = []
+        count = self._top
+        while count and len(result) < k:
+            for key in self._buckets[count]:
+                result.append((key, count))
+                if len(result) == k:
+                    break
+            count = self._lower[count]
+        return result
+
+    def __getitem__(self, key) -> int:
+        return self._counts.get(key, 0)
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+class _GuildStats:
+
+    def __init__(self):
+        self.total = 0
+        self.categories = RankedCounter()
+        # Keyed by category, with None for every category together
+        self.messages = {None: RankedCounter()}  # (channelID, messageID) -> times nominated
+        self.nominators = {None: RankedCounter()}  # authorID -> nominations made
+
+
+class NominationStats:
+
+    def __init__(self):
+        self._guilds = {}  # guildID -> _GuildStats
+        self.ready = False  # False until the counts have been loaded from the database
+        self._recorded_while_loading = None
+
+    def record(self, guildID: int, channelID: int, messageID: int, authorID: int, category: str):
+        """Counts a nomination that was just saved"""
+        if self._recorded_while_loading is not None:
+            self._recorded_while_loading.append((guildID, channelID, messageID, authorID, category))
+        self._count(self._guilds, guildID, channelID, messageID, authorID, category)
+
+    @staticmethod
+    def _count(guilds: dict, guildID: int, channelID: int, messageID: int, authorID: int, category: str):
+        stats = guilds.get(int(guildID))
+        if stats is None:
+            stats = guilds[int(guildID)] = _GuildStats()
+
+        stats.total += 1
+        stats.categories.increment(category)
+        message = (int(channelID), int(messageID))
+        for key in (None, category):
+            stats.messages.setdefault(key, RankedCounter()).increment(message)
+            stats.nominators.setdefault(key, RankedCounter()).increment(int(authorID))
+
+    async def load(self, database, shard_id: int = None, shard_count: int = 1) -> int:
+        """
+        Rebuilds every count from the nominations table.
+        :param database: AsyncSQLManager to count the nominations with
+        :param shard_id: If given, only count guilds this shard handles. Other shards keep their own counts.
+        :param shard_count: Total number of shards
+        :return: Number of nominations counted
+        """
+        self._recorded_while_loading = recorded = []
+        try:
+            watermark, rows = await database.count_nominations(shard_id, shard_count)
+
+            # Whether the count has a nomination recorded meanwhile depends on its ID, not on when it was recorded. A
+            # nomination can be recorded after the count started and still have committed in time to be in it.
+            ids = {}
+            looked_up = 0
+            while looked_up < len(recorded):  # More can be recorded while the IDs are looked up
+                batch, looked_up = recorded[looked_up:], len(recorded)
+                ids.update(await database.get_nomination_ids([(g, m, c) for g, _, m, _, c in batch]))
+        finally:
+            self._recorded_while_loading = None
+
+        # Add everything up first, then rank it all in one go
+        totals = {}
+        categories = {}
+        messages = {}
+        nominators = {}
+        for guildID, category, channelID, messageID, authorID, count in rows.rows():
+            message = (channelID, messageID)
+            totals[guildID] = totals.get(guildID, 0) + count
+            categories.setdefault(guildID, {})
+            categories[guildID][category] = categories[guildID].get(category, 0) + count
+            for key in (None, category):
+                counts = messages.setdefault((guildID, key), {})
+                counts[message] = counts.get(message, 0) + count
+                counts = nominators.setdefault((guildID, key), {})
+                counts[authorID] = counts.get(authorID, 0) + count
+
+        guilds = {}
+        for guildID, total in totals.items():
+            stats = guilds[guildID] = _GuildStats()
+            stats.total = total
+            stats.categories = RankedCounter(categories[guildID])
+        for (guildID, key), counts in messages.items():
+            guilds[guildID].messages[key] = RankedCounter(counts)
+        for (guildID, key), counts in nominators.items():
+            guilds[guildID].nominators[key] = RankedCounter(counts)
+
+        # Only nominations after the count's highest ID are missing from it
+        for nomination in recorded:
+            guildID, _, messageID, _, category = nomination
+            if ids.get((int(guildID), int(messageID), category), 0) > watermark:
+                self._count(guilds, *nomination)
+
+        self._guilds = guilds
+        self.ready = True
+        return sum(totals.values())
+
+    def total(self, guildID: int) -> int:
+        stats = self._guilds.get(int(guildID))
+        return stats.total if stats is not None else 0
+
+    def category_counts(self, guildID: int, k: int = 25) -> list[tuple[str, int]]:
+        """:return: Up to k (category, nominations) pairs for the guild, most nominated first"""
+        stats = self._guilds.get(int(guildID))
+        return stats.categories.top(k) if stats is not None else []
+
+    def top_messages(self, guildID: int, k: int = 10, category: str = None) -> list[tuple[tuple[int, int], int]]:
+        """:return: Up to k ((channelID, messageID), nominations) pairs, most nominated first"""
+        stats = self._guilds.get(int(guildID))
+        if stats is None or category not in stats.messages:
+            return []
+        return stats.messages[category].top(k)
+
+    def top_nominators(self, guildID: int, k: int = 10, category: str = None) -> list[tuple[int, int]]:
+        """:return: Up to k (authorID, nominations made) pairs, most nominations first"""
+        stats = self._guilds.get(int(guildID))
+        if stats is None or category not in stats.nominators:
+            return []
+        return stats.nominators[category].top(k)
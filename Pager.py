@@ -0,0 +1,98 @@
+"""Shows a long result set one embed at a time, with buttons to flip between pages. Pages are only fetched when someone
+asks for them, so a result set of any size costs the same as a single page."""
+import asyncio
+import contextvars
+import uuid
+from typing import Awaitable, Callable, Any
+
+from interactions import SlashContext, Embed, Button, ButtonStyle, ActionRow
+
+from CommandTracer import stage, tracing, current_trace
+
+# Given the position of a page (None for the first one), returns that page's rows and the position of the next page,
+# or None if it's the last one.
+PageFetcher = Callable[[Any], Awaitable[tuple[list, Any]]]
+# Given a page's rows and its page number (starting at 1), builds the embed for it.
+PageRenderer = Callable[[list, int], Awaitable[Embed]]
+
+_listening = set()  # Pagers waiting for button presses. The event loop only keeps weak references to tasks.
+
+
+class Pager:
+
+    def __init__(self, ctx: SlashContext, fetch: PageFetcher, render: PageRenderer, timeout: float = 180):
+        """
+        :param ctx: Context of the command showing the pages
+        :param fetch: Coroutine that loads a page
+        :param render: Coroutine that turns a page into an embed
+        :param timeout: Seconds without a button press before the buttons are removed
+        """
+        self.ctx = ctx
+        self.fetch = fetch
+        self.render = render
+        self.timeout = timeout
+
+        # Custom IDs are unique per pager so two listings in the same channel don't steal each other's clicks
+        token = uuid.uuid4().hex
+        self._prev_id = f"pager_prev:{token}"
+        self._next_id = f"pager_next:{token}"
+
+    def _buttons(self, has_prev: bool, has_next: bool) -> list[ActionRow]:
+        return [ActionRow(
+            Button(style=ButtonStyle.SECONDARY, label="Previous", custom_id=self._prev_id, disabled=not has_prev),
+            Button(style=ButtonStyle.SECONDARY, label="Next", custom_id=self._next_id, disabled=not has_next),
+        )]
+
+    async def start(self) -> bool:
+        """
+        Sends the first page, then handles button presses in the background until the pager times out. Returns as
+        soon as the first page is sent, so the command's trace only covers the command itself.
+        :return: False if there was nothing to show, True otherwise
+        """
+        rows, next_position = await self.fetch(None)
+        if not rows:
+            return False
+
+        embed = await self.render(rows, 1)
+        with stage("send"):
+            message = await self.ctx.send(embeds=embed, components=self._buttons(False, next_position is not None))
+
+        # Each button press is traced on its own, so the listener starts outside of the command's trace
+        trace = current_trace()
+        name = f"{trace.command if trace else 'pager'}.page"
+        task = asyncio.create_task(self._listen(message, next_position, name), context=contextvars.Context())
+        _listening.add(task)
+        task.add_done_callback(_listening.discard)
+        return True
+
+    async def _listen(self, message, next_position, name: str):
+        history = [None]  # Position of every page up to and including the one being shown
+        while True:
+            try:
+                component = await self.ctx.bot.wait_for_component(
+                    messages=message, components=[self._prev_id, self._next_id], timeout=self.timeout)
+            except asyncio.TimeoutError:
+                try:
+                    await message.edit(components=[])
+                except Exception as e:
+                    print(f"Error removing the buttons from a page: {e}")
+                return
+
+            button_ctx = component.ctx
+            shown = list(history)
+            if button_ctx.custom_id == self._next_id and next_position is not None:
+                history.append(next_position)
+            elif button_ctx.custom_id == self._prev_id and len(history) > 1:
+                history.pop()
+
+            try:
+                # Deferred as an update of the page if the database is slow, so the press doesn't fail
+                async with tracing(name, button_ctx, edit_origin=True):
+                    rows, next_position = await self.fetch(history[-1])
+                    embed = await self.render(rows, len(history))
+                    with stage("send"):
+                        await button_ctx.edit_origin(embeds=embed, components=self._buttons(
+                            len(history) > 1, next_position is not None))
+            except Exception as e:
+                history = shown  # Still showing the old page
+                print(f"Error turning the page: {e}")
@@ -0,0 +1,233 @@
+"""Timing for every query SQLManager runs. Queries are grouped by their normalized SQL (literals and parameter lists
+stripped out), and each group gets a latency histogram and a row count. Commits are timed too, and anything slower
+than the slow-query threshold gets logged.
+
+The numbers can be read with summary(), or scraped in Prometheus' text format from serve_metrics()."""
+import asyncio
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r"\b\d+\b")
+_PARAMETER_LIST = re.compile(r"\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)")
+_REPEATED_ROWS = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+")
+_REPEATED_CASES = re.compile(r"(WHEN \? THEN \?)(?:\s+WHEN \? THEN \?)+")
+
+
+def normalize(query: str) -> str:
+    """
+    Boils a query down to its shape, so the same statement with different values or list lengths is counted together.
+    e.g. "SELECT * FROM t WHERE id IN (%s,%s,%s) AND name = 'bob'" -> "SELECT * FROM t WHERE id IN (...) AND name = ?"
+    """
+    query = " ".join(query.split())
+    query = _STRING_LITERAL.sub("?", query)
+    query = _NUMBER.sub("?", query)
+    query = query.replace("%s", "?")
+    query = _PARAMETER_LIST.sub("(...)", query)
+    query = _REPEATED_ROWS.sub(r"\1", query)
+    query = _REPEATED_CASES.sub(r"\1 ...", query)
+    return query
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # Last one is everything slower than the biggest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def observe(self, seconds: float, rows: int = 0):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.rows += max(rows, 0)
+
+
+class QueryMetrics:
+
+    def __init__(self, slow_query_ms: float = 200):
+        """
+        :param slow_query_ms: Queries taking longer than this many milliseconds are logged
+        """
+        self.slow_query_seconds = slow_query_ms / 1000
+        self._statements = {}  # Normalized SQL -> _Histogram
+        self._samples = {}  # Normalized SQL -> (query, params) of the first run, for explaining it later
+        self._commits = _Histogram()
+        self._lock = threading.Lock()
+        self.slow_queries = 0
+
+    def record_query(self, query: str, seconds: float, rows: int, params=None):
+        """
+        :param params: The query's parameters. If given, the first run of each statement is kept as a sample.
+        """
+        statement = normalize(query)
+        with self._lock:
+            histogram = self._statements.get(statement)
+            if histogram is None:
+                histogram = self._statements[statement] = _Histogram()
+            if params is not None and statement not in self._samples:
+                self._samples[statement] = (query, tuple(params))
+            histogram.observe(seconds, rows)
+            if seconds >= self.slow_query_seconds:
+                self.slow_queries += 1
+
+        if seconds >= self.slow_query_seconds:
+            print(f"Slow query ({seconds * 1000:.0f}ms, {rows} rows): {statement}")
+
+    def record_commit(self, seconds: float):
+        with self._lock:
+            self._commits.observe(seconds)
+
+    def samples(self) -> dict:
+        """:return: A real run of each sampled statement, as normalized SQL -> (query, params), most total time first"""
+        with self._lock:
+            return {statement: self._samples[statement] for statement in
+                    sorted(self._samples, key=lambda statement: self._statements[statement].sum, reverse=True)}
+
+    def summary(self, top: int = 10) -> dict:
+        """
+        :param top: How many statements to include, most total time first
+        :return: Per-statement counts and timings (in milliseconds), plus commit timings
+        """
+        with self._lock:
+            statements = sorted(self._statements.items(), key=lambda item: item[1].sum, reverse=True)[:top]
+            return {
+                "statements": [{
+                    "statement": statement,
+                    "count": h.count,
+                    "total_ms": h.sum * 1000,
+                    "avg_ms": h.sum / h.count * 1000,
+                    "max_ms": h.max * 1000,
+                    "rows": h.rows,
+                } for statement, h in statements],
+                "commits": self._commits.count,
+                "commit_avg_ms": self._commits.sum / self._commits.count * 1000 if self._commits.count else 0.0,
+                "slow_queries": self.slow_queries,
+            }
+
+    def render(self, extra_gauges: dict = None) -> str:
+        """
+        :param extra_gauges: Other numbers to export, e.g. connection pool stats, as name -> value
+        :return: Every metric in Prometheus' text exposition format
+        """
+        lines = []
+        with self._lock:
+            lines += ["# HELP nakamoto_sql_query_seconds Time spent running each statement",
+                      "# TYPE nakamoto_sql_query_seconds histogram"]
+            for statement, histogram in self._statements.items():
+                lines += _render_histogram("nakamoto_sql_query_seconds", histogram, f'statement="{_escape(statement)}"')
+
+            lines += ["# HELP nakamoto_sql_rows_total Rows returned or changed by each statement",
+                      "# TYPE nakamoto_sql_rows_total counter"]
+            for statement, histogram in self._statements.items():
+                lines.append(f'nakamoto_sql_rows_total{{statement="{_escape(statement)}"}} {histogram.rows}')
+
+            lines += ["# HELP nakamoto_sql_commit_seconds Time spent committing",
+                      "# TYPE nakamoto_sql_commit_seconds histogram"]
+            lines += _render_histogram("nakamoto_sql_commit_seconds", self._commits)
+
+            lines += ["# TYPE nakamoto_sql_slow_queries_total counter",
+                      f"nakamoto_sql_slow_queries_total {self.slow_queries}"]
+
+        for name, value in (extra_gauges or {}).items():
+            if isinstance(value, bool):
+                value = int(value)  # Prometheus only takes numbers, and rejects the whole scrape over a "True"
+            lines += [f"# TYPE nakamoto_{name} gauge", f"nakamoto_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_histogram(name: str, histogram: _Histogram, labels: str = "") -> list[str]:
+    prefix = labels + "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+
+class InstrumentedCursor:
+    """Wraps a cursor so every query it runs is timed."""
+
+    def __init__(self, cursor, metrics: QueryMetrics, sample: bool = True):
+        """
+        :param sample: Whether to keep the queries as samples for explaining. Turn it off for queries that are meant
+        to read whole tables.
+        """
+        self._cursor = cursor
+        self._metrics = metrics
+        self._sample = sample
+
+    def execute(self, query: str, params=()):
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(query, params)
+        finally:
+            self._metrics.record_query(query, time.perf_counter() - start, self._cursor.rowcount,
+                                       params if self._sample else None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class InstrumentedConnection:
+    """Wraps a connection so its commits are timed."""
+
+    def __init__(self, cnx, metrics: QueryMetrics):
+        self._cnx = cnx
+        self._metrics = metrics
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            self._cnx.commit()
+        finally:
+            self._metrics.record_commit(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+
+async def serve_metrics(render, host: str = "127.0.0.1", port: int = 9108) -> asyncio.AbstractServer:
+    """
+    Serves metrics over HTTP for Prometheus to scrape. Any path returns the metrics.
+    :param render: Function returning the metrics text. Called on every request.
+    :return: The running server
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Read and ignore the request. Every request gets the metrics.
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except Exception as e:
+            print(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Serving database metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,106 @@
+"""Typed rows for the tables SQLManager reads. Each is a NamedTuple, so a row costs no more memory than the plain tuple
+the database driver hands back, but its columns can be read by name and queries can list exactly the columns they
+need instead of SELECT *.
+
+Large result sets can also be decoded into a ColumnSet, which keeps each column in its own compact array instead of
+keeping a tuple (and an int object per value) for every row."""
+from array import array
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+
+class Wallet(NamedTuple):
+    userID: int
+    cryptofavors: int
+
+
+class Transaction(NamedTuple):
+    transactionID: int
+    sender: int
+    receiver: int
+    amount: int
+    status: str
+    created: datetime
+    completed: datetime | None
+
+
+class Nomination(NamedTuple):
+    nominationID: int
+    guildID: int
+    channelID: int
+    messageID: int
+    authorID: int
+    category: str
+    message: str | None
+
+
+class Category(NamedTuple):
+    name: str
+
+
+class Complaint(NamedTuple):
+    complaintID: int
+    guildID: int
+    channelID: int
+    messageID: int
+    authorID: int
+    content: str | None
+    created: datetime
+
+
+class InitiativeRoll(NamedTuple):
+    guildID: int
+    channelID: int
+    character: int | str  # A player's discord ID, or an NPC's name
+    roll: int
+
+
+def columns(row_type, prefix: str = "") -> str:
+    """:return: The row type's columns as a SELECT list, e.g. "userID, cryptofavors" """
+    return ", ".join(prefix + field for field in row_type._fields)
+
+
+@lru_cache(maxsize=64)
+def projection(row_type, fields: tuple[str, ...]):
+    """
+    :param row_type: Row type to take the columns from
+    :param fields: Columns to keep, in order
+    :return: A row type with just those columns, named after the original (e.g. NominationProjection)
+    """
+    unknown = [field for field in fields if field not in row_type._fields]
+    if unknown:
+        raise ValueError(f"{row_type.__name__} has no column(s) {', '.join(unknown)}")
+    return NamedTuple(f"{row_type.__name__}Projection", [(field, row_type.__annotations__[field]) for field in fields])
+
+
+class ColumnSet:
+    """
+    A result set stored column by column. Integer columns are packed into arrays of 64-bit ints (8 bytes a value,
+    instead of an int object and a tuple slot), and everything else goes in a list.
+    """
+
+    def __init__(self, names: tuple[str, ...], integer: tuple[str, ...] = ()):
+        """
+        :param names: Column names, in the order the rows have them
+        :param integer: Columns that only ever hold integers (and never NULL)
+        """
+        self.names = tuple(names)
+        self._columns = [array("q") if name in integer else [] for name in self.names]
+
+    def extend(self, rows):
+        """Adds rows to the end. Each row's values are copied into the columns, so the row itself can be dropped."""
+        for row in rows:
+            for column, value in zip(self._columns, row):
+                column.append(value)
+
+    def __getitem__(self, name: str):
+        """:return: Every value of a column, in row order"""
+        return self._columns[self.names.index(name)]
+
+    def rows(self):
+        """Yields the rows back as tuples, one at a time"""
+        return zip(*self._columns)
+
+    def __len__(self) -> int:
+        return len(self._columns[0]) if self._columns else 0
@@ -0,0 +1,264 @@
+"""The database engines SQLManager can run on. SQLManager's queries are written in MySQL's dialect, and each backend
+knows how to open a connection and get those queries to run on its engine.
+
+The engine is picked with SQL_BACKEND in the .env:
+    mysql  - (default) The MySQL server described by SQL_USER, SQL_PASSWORD, SQL_HOST, SQL_PORT and SQL_DATABASE
+    sqlite - An embedded database in the file SQLITE_PATH (nakamoto.db by default). Handy for small deployments,
+             running the bot offline, and benchmarking without a server.
+"""
+import os
+import re
+import sqlite3
+from functools import lru_cache
+
+
+class SQLBackend:
+    name: str
+
+    def connect(self):
+        """:return: A brand-new connection"""
+        raise NotImplementedError
+
+    def cursor(self, cnx):
+        """:return: A cursor on the connection that accepts SQLManager's queries"""
+        raise NotImplementedError
+
+    def streaming_cursor(self, cnx):
+        """:return: A cursor that reads rows from the server as they're fetched, instead of all at once up front"""
+        raise NotImplementedError
+
+    def ping(self, cnx) -> bool:
+        """:return: Whether the connection still works"""
+        raise NotImplementedError
+
+    def is_disconnect(self, error: Exception) -> bool:
+        """:return: Whether the error means the connection was lost, rather than something being wrong with a query"""
+        return False
+
+    def match_nominations(self, text: str) -> tuple[str, str, tuple, str, tuple]:
+        """
+        How to run a full-text search over the message of each nomination. The nominations table is aliased as n.
+        :param text: What to search for, as typed by a user
+        :return: (JOIN clause, WHERE condition, its params, ORDER BY expression with the best matches first, its params)
+        """
+        raise NotImplementedError
+
+    def has_index(self, cursor, table: str, name: str) -> bool:
+        """:return: Whether the table has an index with that name"""
+        raise NotImplementedError
+
+    def lock_schema(self, cursor):
+        """Waits for any other process that's migrating the schema to finish, then keeps the rest out until unlocked"""
+
+    def unlock_schema(self, cursor):
+        pass
+
+    def full_scans(self, cnx, query: str, params=()) -> list[str]:
+        """
+        Asks the engine how it would run a query, without running it.
+        :return: Tables the query would read every row of
+        """
+        raise NotImplementedError
+
+
+class MySQLBackend(SQLBackend):
+    name = "mysql"
+    # The tables and indexes SQLManager expects are created by Schema.py
+
+    def connect(self):
+        import mysql.connector  # Only needed when this backend is actually used
+        from mysql.connector.constants import ClientFlag
+
+        return mysql.connector.connect(user=os.getenv("SQL_USER"), password=os.getenv("SQL_PASSWORD"),
+                                       host=os.getenv("SQL_HOST"), port=os.getenv("SQL_PORT"),
+                                       database=os.getenv("SQL_DATABASE"),
+                                       # Report matched rows rather than changed rows, so rowcount tells us whether
+                                       # an UPDATE found its row even if the values didn't change
+                                       client_flags=[ClientFlag.FOUND_ROWS])
+
+    def cursor(self, cnx):
+        # The connector fills parameters in on the client and sends plain SQL, so nothing is prepared on the server.
+        # Server-side prepared cursors (prepared=True) can't be buffered and cost an extra round trip per new cursor,
+        # and MySQL plans a prepared statement again on every execution anyway, so they'd only save parsing.
+        return cnx.cursor(buffered=True)
+
+    def streaming_cursor(self, cnx):
+        # Unbuffered, so rows stay on the server until fetched. The connection can't run anything else until every
+        # row has been read.
+        return cnx.cursor(buffered=False)
+
+    def ping(self, cnx) -> bool:
+        cnx.ping(reconnect=False)  # Raises if the server hung up
+        return True
+
+    def match_nominations(self, text: str) -> tuple[str, str, tuple, str, tuple]:
+        # Uses the FULLTEXT index on the message column
+        match = "MATCH(n.message) AGAINST(%s IN NATURAL LANGUAGE MODE)"
+        return "", match, (text,), match + " DESC", (text,)
+
+    def is_disconnect(self, error: Exception) -> bool:
+        from mysql.connector import errors, errorcode
+
+        # Server gone away, lost connection during query, and friends
+        lost = (errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST, errorcode.CR_CONNECTION_ERROR,
+                errorcode.CR_CONN_HOST_ERROR, errorcode.CR_SERVER_LOST_EXTENDED)
+        return isinstance(error, (errors.OperationalError, errors.InterfaceError)) and \
+            (error.errno in lost or error.errno is None)
+
+    def has_index(self, cursor, table: str, name: str) -> bool:
+        cursor.execute("SELECT 1 FROM information_schema.statistics "
+                       "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1", (table, name))
+        return cursor.fetchone() is not None
+
+    def lock_schema(self, cursor):
+        cursor.execute("SELECT GET_LOCK('nakamoto_schema', 600)")
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for another process to finish migrating the schema")
+
+    def unlock_schema(self, cursor):
+        cursor.execute("SELECT RELEASE_LOCK('nakamoto_schema')")
+        cursor.fetchall()
+
+    def full_scans(self, cnx, query: str, params=()) -> list[str]:
+        cursor = cnx.cursor(buffered=True, dictionary=True)
+        try:
+            cursor.execute("EXPLAIN " + query, params)
+            return [row["table"] for row in cursor.fetchall() if row["type"] == "ALL"]
+        finally:
+            cursor.close()
+
+
+@lru_cache(maxsize=512)
+def _to_sqlite(query: str) -> tuple[str, bool]:
+    """
+    Rewrites a MySQL query into SQLite's dialect.
+    :return: (rewritten query, whether the query asked for row locks)
+    """
+    locks = query.rstrip().upper().endswith(" FOR UPDATE")
+    if locks:
+        query = query.rstrip()[:-len(" FOR UPDATE")]
+
+    query = query.replace("CURRENT_TIMESTAMP() - INTERVAL %s SECOND", "datetime('now', '-' || %s || ' seconds')")
+    query = query.replace("%s", "?")
+    query = query.replace("CURRENT_TIMESTAMP()", "CURRENT_TIMESTAMP")
+    query = query.replace("LAST_INSERT_ID()", "last_insert_rowid()")
+    query = re.sub(r"\bINSERT IGNORE\b", "INSERT OR IGNORE", query)
+
+    upsert = re.search(r"\bON DUPLICATE KEY UPDATE\b", query)
+    if upsert:
+        assignments = re.sub(r"VALUES\((`?\w+`?)\)", r"excluded.\1", query[upsert.end():])
+        query = query[:upsert.start()] + "ON CONFLICT DO UPDATE SET" + assignments
+
+    return query, locks
+
+
+class _SQLiteCursor:
+    """Wraps a sqlite3 cursor so it takes the same queries as a MySQL one."""
+
+    def __init__(self, cnx: sqlite3.Connection):
+        self._cnx = cnx
+        self._cursor = cnx.cursor()
+
+    def execute(self, query: str, params=()):
+        query, locks = _to_sqlite(query)
+        if locks and not self._cnx.in_transaction:
+            # SQLite locks the whole database rather than rows. Take the write lock now, the way FOR UPDATE would,
+            # so nothing can change what we just read before we write.
+            self._cursor.execute("BEGIN IMMEDIATE")
+        self._cursor.execute(query, params)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size: int = None):
+        return self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self) -> int:
+        return self._cursor.lastrowid
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteBackend(SQLBackend):
+    name = "sqlite"
+
+    def __init__(self, path: str = None):
+        """
+        :param path: Database file. Defaults to SQLITE_PATH from the .env, or nakamoto.db.
+        """
+        self.path = path or os.getenv("SQLITE_PATH", "nakamoto.db")
+
+    def connect(self) -> sqlite3.Connection:
+        # Each connection is only used by one thread at a time (the pool makes sure of that), but not always the same
+        # thread, hence check_same_thread=False
+        cnx = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        cnx.execute("PRAGMA journal_mode=WAL")  # Readers don't block the writer and vice versa
+        cnx.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, and much cheaper commits
+        return cnx
+
+    def cursor(self, cnx: sqlite3.Connection) -> _SQLiteCursor:
+        return _SQLiteCursor(cnx)
+
+    def streaming_cursor(self, cnx: sqlite3.Connection) -> _SQLiteCursor:
+        return _SQLiteCursor(cnx)  # SQLite only steps through rows as they're fetched anyway
+
+    def ping(self, cnx: sqlite3.Connection) -> bool:
+        cnx.execute("SELECT 1")
+        return True
+
+    def is_disconnect(self, error: Exception) -> bool:
+        return isinstance(error, sqlite3.ProgrammingError) and "closed" in str(error)
+
+    def has_index(self, cursor: _SQLiteCursor, table: str, name: str) -> bool:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+                       (table, name))
+        return cursor.fetchone() is not None
+
+    # No schema lock: SQLite only lets one connection write at a time anyway, and every migration can safely run twice
+
+    def full_scans(self, cnx: sqlite3.Connection, query: str, params=()) -> list[str]:
+        query, _ = _to_sqlite(query)
+        # Each row's last column describes a step, e.g. "SEARCH nominations USING INDEX ..." or "SCAN nominations".
+        # Older versions say "SCAN TABLE nominations". Virtual tables and index-only scans mention their index.
+        scans = []
+        for *_, detail in cnx.execute("EXPLAIN QUERY PLAN " + query, params).fetchall():
+            words = detail.replace("SCAN TABLE ", "SCAN ").split()
+            if words[0] == "SCAN" and "INDEX" not in words and words[1] != "CONSTANT":
+                scans.append(words[1])
+        return scans
+
+    def match_nominations(self, text: str) -> tuple[str, str, tuple, str, tuple]:
+        # Quote every word so nothing the user types is read as FTS5 query syntax. Any word can match, and bm25 ranks
+        # messages that match more (and rarer) words higher.
+        words = " OR ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+        return "JOIN nominations_fts ON nominations_fts.rowid = n.nominationID", "nominations_fts MATCH %s", \
+            (words,), "bm25(nominations_fts)", ()
+
+
+_BACKENDS = {
+    "mysql": MySQLBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def get_backend(name: str = None) -> SQLBackend:
+    """
+    :param name: mysql or sqlite. Defaults to SQL_BACKEND from the .env, or mysql.
+    :return: A new backend of that type
+    """
+    name = (name or os.getenv("SQL_BACKEND", "mysql")).lower()
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown SQL_BACKEND {name}. Pick one of: {', '.join(_BACKENDS)}")
+    return _BACKENDS[name]()
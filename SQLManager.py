@@ -1,238 +1,814 @@
 """This module acts as the connection between the bot and the SQL management folder. Everything outside the directory
 should only interact with this module"""
 import interactions
-import mysql.connector
 
+import functools
 import os
+import sys
+import threading
 from dotenv import load_dotenv
 
-from mysql.connector import MySQLConnection
+from contextlib import contextmanager
+from itertools import islice
 
 from interactions import User
 
+from Cache import TTLCache
+from ConnectionPool import ConnectionPool
+from QueryMetrics import QueryMetrics, InstrumentedCursor, InstrumentedConnection
+from Rows import Wallet, Transaction, Nomination, Category, Complaint, InitiativeRoll, ColumnSet, columns, projection
+from SQLBackend import SQLBackend, get_backend
+from Sharding import SHARD_COUNT
+import Schema
+
 load_dotenv()  # Loads the .env file
 
+# Tables that can be exported, with their columns. Rows come out in primary key order.
+EXPORTABLE_TABLES = {
+    "transactions": Transaction._fields,
+    "nominations": Nomination._fields,
+    "wallet": Wallet._fields,
+    "complaints": Complaint._fields,
+}
+
+_READ_ATTEMPTS = 3  # How many times a read is tried if the connection drops out from under it
+
+
+def _retry_reads(method):
+    """
+    Decorator for methods that only read. If the connection drops mid-query, the pool throws it away and the read is
+    tried again on a fresh one, so an idle timeout never reaches the user. Only safe for methods that don't write.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(_READ_ATTEMPTS):
+            try:
+                return method(self, *args, **kwargs)
+            except Exception as e:
+                if attempt == _READ_ATTEMPTS - 1 or not self.backend.is_disconnect(e):
+                    raise
+                print(f"Lost the database connection during {method.__name__}, retrying: {e}")
+    return wrapper
 
-class SQLManager:
-    # cnx: MySQLConnection  # The connection used to connect to the database
 
-    # TODO: Keeping the connection open the entire time wastes resources, and doesn't work seeing as the connection
-    # TODO:     closes itself anyways. Instead, just have a method or class that opens a connection whenever we need it.
+class SQLManager:
 
-    def __init__(self):
-        # self._connection = SQLConnection()
-        print("Establishing connection to Nakamoto database...")
-        self.cnx = mysql.connector.connect(user=os.getenv("SQL_USER"), password=os.getenv("SQL_PASSWORD"),
-                                           host=os.getenv("SQL_HOST"), port=os.getenv("SQL_PORT"),
-                                           database=os.getenv("SQL_DATABASE"))
-        self.cursor = self.cnx.cursor(buffered=True)  # This is used to interact with the actual database
-        print("Connection Established.\n\n")
+    def __init__(self, pool_size: int = None, backend: SQLBackend = None, lazy: bool = None):
+        """
+        Sets up the connection pool. Connections are opened as they're needed, up to pool_size at once, and every
+        method checks out its own connection and cursor so callers on different threads never share one.
+
+        :param pool_size: Maximum number of open connections. Defaults to SQL_POOL_SIZE from the .env, or 5.
+        :param backend: Database engine to use. Defaults to the one picked by SQL_BACKEND in the .env.
+        :param lazy: If True, no connection is opened until the first query, so a database outage can't stop the bot
+        from starting. If False, one is opened right away so a bad config fails immediately. Defaults to
+        SQL_LAZY_CONNECT from the .env, or True.
+        """
+        if pool_size is None:
+            pool_size = int(os.getenv("SQL_POOL_SIZE", 5))
+        if lazy is None:
+            lazy = os.getenv("SQL_LAZY_CONNECT", "true").lower() in ("1", "true", "yes")
+        self.backend = backend or get_backend()
+
+        self.metrics = QueryMetrics(slow_query_ms=float(os.getenv("SQL_SLOW_QUERY_MS", 200)))
+
+        # Nicknames we know are already in the users table, so syncing users only writes the ones that changed. With
+        # several shards, another process can change a user's row behind our back, so entries expire after a while.
+        self._nicknames = TTLCache(max_size=int(os.getenv("SQL_NICKNAME_CACHE_SIZE", 100_000)),
+                                   ttl=float(os.getenv("SQL_NICKNAME_CACHE_TTL", 300)) if SHARD_COUNT > 1 else None)
+
+        # Wallet rows by userID. Our own writes drop what they changed once they commit, so it never shows a balance
+        # older than one we wrote. Anything else that writes to the wallet table has to call invalidate_wallet().
+        # Wallets aren't tied to a guild, so with several shards the other processes (e.g. shard 0's sweeper) write
+        # them too. There's no way to hear about those writes, so sharded bots don't cache wallets by default.
+        self._wallets = TTLCache(max_size=int(os.getenv("SQL_WALLET_CACHE_SIZE", 10_000 if SHARD_COUNT == 1 else 0)))
+        self._wallet_lock = threading.Lock()
+        self._wallet_writes = 0  # Goes up on every wallet write, so a read that raced one knows not to cache
+
+        # (guildID, messageID, category) of every nomination we know is saved, so duplicates are turned away without
+        # asking the database. The unique index on the table still catches anything this hasn't seen.
+        self._nominated = set()
+        self._nominated_lock = threading.Lock()
+
+        self._pool = ConnectionPool(self.backend.connect, size=pool_size, ping=self.backend.ping,
+                                    check_after=float(os.getenv("SQL_HEALTH_CHECK_SECONDS", 30)))
+        if not lazy:
+            print(f"Establishing connection to Nakamoto database ({self.backend.name})...")
+            with self._cursor():
+                pass  # Open the first connection now so a bad config fails at startup rather than on the first command
+            print("Connection Established.\n\n")
+
+    @contextmanager
+    def _cursor(self, streaming: bool = False, full_scan: bool = False):
+        """
+        Checks a connection out of the pool for the duration of a with block.
+        :param streaming: If True, the cursor fetches rows from the server as they're asked for instead of all at once
+        :param full_scan: If True, the queries are meant to read whole tables, so Schema.check_plans leaves them out
+        :return: (connection, cursor). Anything left uncommitted when the block ends is rolled back.
+        """
+        cnx = self._pool.acquire()
+        reusable = False
+        try:
+            # This is used to interact with the actual database. Every query and commit through it is timed.
+            cursor = self.backend.streaming_cursor(cnx) if streaming else self.backend.cursor(cnx)
+            cursor = InstrumentedCursor(cursor, self.metrics, sample=not full_scan)
+            try:
+                yield InstrumentedConnection(cnx, self.metrics), cursor
+                reusable = True
+            finally:
+                try:
+                    cursor.close()
+                    if cnx.in_transaction:
+                        cnx.rollback()
+                except Exception as e:
+                    # The connection is probably dead, or a streaming read left rows on it. Don't hide the original
+                    # error, the connection gets thrown away either way.
+                    reusable = False
+                    print(f"Error cleaning up database connection: {e}")
+        finally:
+            # Anything but a clean exit (an error, or a streaming generator closed part way) throws the connection away
+            self._pool.release(cnx, discard=not reusable)
+
+    def _commit_wallets(self, cnx, userIDs):
+        """
+        Commits a transaction that changed wallets, then drops them from the wallet cache so the next read gets the
+        new balances. Dropping rather than writing through means commits don't have to take turns to keep the cache
+        in order. The lock only covers the cache itself.
+        :param userIDs: Users whose wallets the transaction changed
+        """
+        cnx.commit()
+        with self._wallet_lock:
+            self._wallet_writes += 1
+            for userID in userIDs:
+                self._wallets.invalidate(int(userID))
+
+    @staticmethod
+    def _credit_wallets(cursor, credits: dict[int, int]):
+        """
+        Adds favors to several wallets with one UPDATE, inside the caller's transaction. The database does the
+        arithmetic, so concurrent transfers to the same wallet can't overwrite each other.
+        :param credits: userID -> favors to add
+        """
+        cases = " ".join(["WHEN %s THEN %s"] * len(credits))
+        placeholders = ",".join(["%s"] * len(credits))
+        query_creditWallets = f"UPDATE wallet SET cryptofavors = cryptofavors + CASE userID {cases} END " \
+                              f"WHERE userID IN ({placeholders})"
+        params = [value for credit in credits.items() for value in credit] + list(credits)
+        cursor.execute(query_creditWallets, tuple(params))
+
+    def invalidate_wallet(self, userID: int = None):
+        """
+        Forgets cached wallets. Call this after changing the wallet table from outside of SQLManager.
+        :param userID: Wallet to forget. None forgets all of them.
+        """
+        with self._wallet_lock:
+            self._wallet_writes += 1
+            if userID is None:
+                self._wallets.clear()
+            else:
+                self._wallets.invalidate(int(userID))
+
+    def cache_stats(self) -> dict:
+        """:return: Size and hit counts of the wallet cache"""
+        return {"wallet_cache_size": len(self._wallets), "wallet_cache_hits": self._wallets.hits,
+                "wallet_cache_misses": self._wallets.misses}
+
+    def health(self) -> dict:
+        """:return: Whether the database can be reached, and how often connections have had to be replaced"""
+        return self._pool.health()
+
+    def pool_stats(self) -> dict:
+        """:return: Size, checkout counts and wait times of the connection pool"""
+        return self._pool.stats()
+
+    def migrate(self, delete_duplicates: bool = False) -> list[int]:
+        """
+        Brings the schema up to date (see Schema.migrate). Uses a connection of its own, so the pool never hands out
+        one that's half way through a migration, and a failed migration doesn't stop the pool from connecting.
+        :return: Versions that were applied
+        """
+        cnx = self.backend.connect()
+        try:
+            return Schema.migrate(self.backend, cnx, delete_duplicates)
+        finally:
+            cnx.close()
+
+    @_retry_reads
+    def schema_version(self) -> int:
+        """:return: The newest migration the database has had"""
+        with self._cursor() as (cnx, cursor):
+            cursor.execute("SELECT MAX(version) FROM schema_version")
+            return int(cursor.fetchone()[0] or 0)
+
+    @_retry_reads
+    def full_scans(self, query: str, params=()) -> list[str]:
+        """:return: Tables the query would read every row of, according to the database's query planner"""
+        with self._pool.connection() as cnx:
+            return self.backend.full_scans(cnx, query, params)
 
     def is_closed(self) -> bool:
-        return self.cnx.is_connected()
+        return self._pool.closed
 
     def updateUser(self, user: User):
         """
-        Checks to see if a user has been added to the database yet.
+        Adds a user to the database if they haven't been added yet, or updates their nickname if it changed.
         :param user: user to check
-        :return: True if they exist, false otherwise
         """
-        query_userTable = "SELECT * FROM `users` WHERE `userID` = %s"
-        self.cursor.execute(query_userTable, (int(user.id),))
+        self.sync_users([user])
 
-        result = self.cursor.fetchone()
-
-        if result is None:
-            query_createUser = "INSERT INTO `users`(`userID`, `nickname`) VALUES (%s,%s);"
-            self.cursor.execute(query_createUser, (int(user.id), str(user.username)))
-            # Default in the hard database will handle favors, no need to pass it in here
-            query_createWallet = "INSERT INTO `wallet`(`userID`) VALUES (%s)"
-            self.cursor.execute(query_createWallet, (int(user.id),))
-            self.cnx.commit()
-        else:
-            if str(result[1]) == str(user.username):
-                return
-            query_updateUser = "UPDATE users SET nickname = %s WHERE userID = %s"
-            self.cursor.execute(query_updateUser, (str(user.username), str(user.id)))
-            self.cnx.commit()
+    def sync_users(self, users, chunk_size: int = 1000) -> int:
+        """
+        Adds or renames a lot of users at once, and gives any new ones a wallet. Users are handled chunk_size at a time,
+        with one lookup, one upsert and one commit per chunk, and only new users and changed nicknames get written.
 
-    def get_wallet(self, userID: int) -> tuple:
+        :param users: Iterable of users (or members) to save. It's consumed lazily, so a generator works fine.
+        :param chunk_size: Users per chunk
+        :return: Number of users written, or -1 if a chunk failed (chunks before it are still saved)
         """
-        Gets the wallet of the designated user.
+        users = iter(users)
+        written = 0
+
+        while True:
+            # Later entries for the same user win, same as if they'd been updated one after another
+            chunk = {int(user.id): str(user.username) for user in islice(users, chunk_size)}
+            if not chunk:
+                return written
+
+            # Only look up users we don't already know the nickname of
+            known = {userID: self._nicknames.get(userID) for userID in chunk}
+            unknown = [userID for userID, nickname in known.items() if nickname is None]
+
+            try:
+                with self._cursor() as (cnx, cursor):
+                    if unknown:
+                        query_findUsers = "SELECT userID, nickname FROM `users` WHERE userID IN (" + \
+                                          ",".join(["%s"] * len(unknown)) + ")"
+                        cursor.execute(query_findUsers, tuple(unknown))
+                        for userID, nickname in cursor.fetchall():
+                            known[int(userID)] = str(nickname)
+
+                    changed = [(userID, nickname) for userID, nickname in chunk.items() if known[userID] != nickname]
+                    new = [userID for userID in chunk if known[userID] is None]
+                    if changed:
+                        query_upsertUsers = "INSERT INTO `users`(`userID`, `nickname`) VALUES " + \
+                                            ",".join(["(%s,%s)"] * len(changed)) + \
+                                            " ON DUPLICATE KEY UPDATE `nickname` = VALUES(`nickname`)"
+                        cursor.execute(query_upsertUsers, tuple(value for row in changed for value in row))
+                    if new:
+                        # Default in the hard database will handle favors, no need to pass it in here
+                        query_createWallets = "INSERT IGNORE INTO `wallet`(`userID`) VALUES " + \
+                                              ",".join(["(%s)"] * len(new))
+                        cursor.execute(query_createWallets, tuple(new))
+                    cnx.commit()
+            except Exception as e:
+                print(f"Error syncing {len(chunk)} users: {e}")
+                return -1
+
+            for userID, nickname in chunk.items():
+                self._nicknames.set(userID, nickname)
+            written += len(changed)
+
+    @_retry_reads
+    def get_wallet(self, userID: int) -> Wallet | None:
+        """
+        Gets the wallet of the designated user. Served from the wallet cache when possible.
 
         :param userID: ID of the user to get
-        :return: Nickname and Cryptofavors formatted in a list
+        :return: The user's Wallet, or None if they don't have one
         """
-
-        # Runs query() in SQLConnection, then fetches the result from the cursor
-        self.cursor.execute("SELECT * FROM wallet WHERE userID = %s", (userID,))
-        return self.cursor.fetchone()
+        userID = int(userID)
+        wallet = self._wallets.get(userID)
+        if wallet is not None:
+            return wallet
+
+        writes = self._wallet_writes
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(f"SELECT {columns(Wallet)} FROM wallet WHERE userID = %s", (userID,))
+            wallet = cursor.fetchone()
+
+        if wallet is not None:
+            wallet = Wallet._make(wallet)
+            with self._wallet_lock:
+                # If a write committed while we were reading, what we read might already be out of date
+                if writes == self._wallet_writes:
+                    self._wallets.set(userID, wallet)
+        return wallet
 
     def add_transaction(self, sender: int, receiver: int, amount: int):
         query_addTransaction = "INSERT INTO `transactions`(`sender`, `receiver`, `amount`, `status`) " \
-                               "VALUES ('%s','%s','%s','PENDING')"
-
-        self.cursor.execute(query_addTransaction, (sender, receiver, amount))
+                               "VALUES (%s,%s,%s,'PENDING')"
 
-        query_selectLast = "SELECT LAST_INSERT_ID()"
-        self.cursor.execute(query_selectLast)
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(query_addTransaction, (sender, receiver, amount))
 
-        result = self.cursor.fetchone()[0]
-        # print(f"Transaction ID in SQLManager: {result}")
+            result = cursor.lastrowid  # ID the database gave the new transaction
+            # print(f"Transaction ID in SQLManager: {result}")
 
-        self.cnx.commit()
-        return result
+            cnx.commit()
+            return result
 
-    def confirm_transaction(self, transaction_id: int, userID: int):
-        # Find the transaction and check that it was found
-        query_findTransaction = "SELECT * FROM transactions WHERE transactionID=%s"
-        self.cursor.execute(query_findTransaction, (transaction_id,))
-        transaction = self.cursor.fetchone()
-
-        # Check that it exists
-        if transaction is None:
-            return -1
-        # If the person requesting to confirm the transaction is not the original sender, error out
-        elif int(transaction[1]) != userID:
-            return -2
-        elif transaction[4] != "PENDING":
-            return -3
+    @_retry_reads
+    def get_transaction(self, transaction_id: int) -> Transaction | None:
+        """:return: The transaction, or None if it doesn't exist"""
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(f"SELECT {columns(Transaction)} FROM transactions WHERE transactionID = %s",
+                           (transaction_id,))
+            row = cursor.fetchone()
+        return Transaction._make(row) if row is not None else None
 
-        # Get current timestamp to mark transaction completed with
-        query_getTimestamp = "SELECT CURRENT_TIMESTAMP()"
-        self.cursor.execute(query_getTimestamp)
-        timestamp = self.cursor.fetchone()[0]
+    def _settle(self, transaction_id: int, userID: int, status: str):
+        """
+        Closes out a pending transaction and pays whoever ends up with the favors, all in one database transaction.
+        The transaction row is locked while it's checked, so two people settling it at once can't both pay out.
 
-        query_updateTransaction = "UPDATE transactions SET status = %s, completed = %s WHERE transactionID = %s"
-        self.cursor.execute(query_updateTransaction, ("COMPLETED", timestamp, transaction_id))
-        self.cnx.commit()
+        :param status: COMPLETED pays the receiver, CANCELLED refunds the sender
+        :return: None if successful, -1 if it doesn't exist, -2 if userID isn't the sender, -3 if it isn't pending
+        """
+        with self._cursor() as (cnx, cursor):
+            # Find the transaction and check that it was found
+            row_type = projection(Transaction, ("sender", "receiver", "amount", "status"))
+            query_findTransaction = f"SELECT {columns(row_type)} FROM transactions " \
+                                    f"WHERE transactionID = %s FOR UPDATE"
+            cursor.execute(query_findTransaction, (transaction_id,))
+            transaction = cursor.fetchone()
+
+            # Check that it exists
+            if transaction is None:
+                return -1
+            sender, receiver, amount, current_status = row_type._make(transaction)
+            # If the person requesting to confirm the transaction is not the original sender, error out
+            if int(sender) != userID:
+                return -2
+            elif current_status != "PENDING":
+                return -3
+
+            query_updateTransaction = "UPDATE transactions SET status = %s, completed = CURRENT_TIMESTAMP() " \
+                                      "WHERE transactionID = %s"
+            cursor.execute(query_updateTransaction, (status, transaction_id))
+
+            # Let the database do the arithmetic so concurrent transfers to the same wallet can't overwrite each other
+            query_updateWallet = "UPDATE wallet SET cryptofavors = cryptofavors + %s WHERE userID = %s"
+            payee = receiver if status == "COMPLETED" else sender
+            cursor.execute(query_updateWallet, (amount, payee))
+            self._commit_wallets(cnx, [payee])
 
-        self.edit_favors(transaction[2], transaction[3])  # Update the receiver's favors
+    def confirm_transaction(self, transaction_id: int, userID: int):
+        """
+        Completes a pending transaction and gives the favors to the receiver.
+        :param userID: ID of the user confirming it. Has to be the sender.
+        :return: None if successful, -1 if it doesn't exist, -2 if userID isn't the sender, -3 if it isn't pending
+        """
+        return self._settle(transaction_id, userID, "COMPLETED")
 
     def cancel_transaction(self, transaction_id: int, userID: int):
-        # Find the transaction and check that it was found
-        query_findTransaction = "SELECT * FROM transactions WHERE transactionID=%s"
-        self.cursor.execute(query_findTransaction, (transaction_id,))
-        transaction = self.cursor.fetchone()
+        """
+        Cancels a pending transaction and refunds the sender's favors.
+        :param userID: ID of the user cancelling it. Has to be the sender.
+        :return: None if successful, -1 if it doesn't exist, -2 if userID isn't the sender, -3 if it isn't pending
+        """
+        return self._settle(transaction_id, userID, "CANCELLED")
 
-        # Check that it exists
-        if transaction is None:
-            return -1
-        # If the person requesting to confirm the transaction is not the original sender, error out
-        elif int(transaction[1]) != userID:
-            return -2
-        elif transaction[4] != "PENDING":
-            return -3
+    def settle_transactions(self, transaction_ids, userID: int = None) -> list[int]:
+        """
+        Confirms a batch of pending transactions at once, with a single commit. IDs that don't exist or aren't pending
+        anymore are skipped.
 
-        query_markAsCancelled = "UPDATE transactions SET status = 'CANCELLED' WHERE transactionID = %s"
-        self.cursor.execute(query_markAsCancelled, (transaction_id,))
-        self.cnx.commit()
+        :param transaction_ids: IDs of the transactions to confirm
+        :param userID: If given, only transactions sent by this user are confirmed
+        :return: IDs of the transactions that were confirmed
+        """
+        transaction_ids = list(dict.fromkeys(int(i) for i in transaction_ids))
+        if not transaction_ids:
+            return []
+
+        with self._cursor() as (cnx, cursor):
+            placeholders = ",".join(["%s"] * len(transaction_ids))
+            query_findTransactions = f"SELECT transactionID, receiver, amount FROM transactions " \
+                                     f"WHERE transactionID IN ({placeholders}) AND status = 'PENDING'"
+            params = list(transaction_ids)
+            if userID is not None:
+                query_findTransactions += " AND sender = %s"
+                params.append(userID)
+            cursor.execute(query_findTransactions + " FOR UPDATE", tuple(params))
+            transactions = cursor.fetchall()
+
+            if not transactions:
+                return []
+
+            settled = [int(t[0]) for t in transactions]
+            placeholders = ",".join(["%s"] * len(settled))
+            query_updateTransactions = f"UPDATE transactions SET status = 'COMPLETED', " \
+                                       f"completed = CURRENT_TIMESTAMP() WHERE transactionID IN ({placeholders})"
+            cursor.execute(query_updateTransactions, tuple(settled))
+
+            # Add up what each receiver gets so every wallet is only touched once
+            credits = {}
+            for _, receiver, amount in transactions:
+                credits[int(receiver)] = credits.get(int(receiver), 0) + int(amount)
+
+            self._credit_wallets(cursor, credits)
+            self._commit_wallets(cnx, credits)
+            return settled
+
+    def cancel_stale_transactions(self, max_age: float, limit: int = 200) -> list:
+        """
+        Cancels the oldest pending transactions that have sat around for too long and refunds their senders, all in
+        one database transaction.
 
-        # Refund the sender's favors
-        self.edit_favors(transaction[1], transaction[3])
+        :param max_age: Seconds a transaction can stay pending
+        :param limit: Most transactions to cancel. Call again until it returns nothing to clear out all of them.
+        :return: The cancelled transactions, each with its transactionID, sender and amount
+        """
+        row_type = projection(Transaction, ("transactionID", "sender", "amount"))
+        with self._cursor() as (cnx, cursor):
+            # Walks the (status, created) index from the oldest pending transaction, so it never reads a settled one
+            query_findStale = f"SELECT {columns(row_type)} FROM transactions " \
+                              f"WHERE status = 'PENDING' AND created < CURRENT_TIMESTAMP() - INTERVAL %s SECOND " \
+                              f"ORDER BY status, created LIMIT %s FOR UPDATE"
+            cursor.execute(query_findStale, (int(max_age), int(limit)))
+            stale = [row_type._make(row) for row in cursor.fetchall()]
+            if not stale:
+                return []
+
+            placeholders = ",".join(["%s"] * len(stale))
+            query_cancelTransactions = f"UPDATE transactions SET status = 'CANCELLED', " \
+                                       f"completed = CURRENT_TIMESTAMP() WHERE transactionID IN ({placeholders})"
+            cursor.execute(query_cancelTransactions, tuple(t.transactionID for t in stale))
+
+            # Add up each sender's refund so every wallet is only touched once
+            refunds = {}
+            for t in stale:
+                refunds[int(t.sender)] = refunds.get(int(t.sender), 0) + int(t.amount)
+
+            self._credit_wallets(cursor, refunds)
+            self._commit_wallets(cnx, refunds)
+            return stale
 
     def edit_favors(self, userID: int, amount: int):
-        # Get the number of favors from the selected user's wallet
-        query_selectWallet = "SELECT cryptofavors FROM wallet WHERE userID=%s"
-        self.cursor.execute(query_selectWallet, (userID,))
-        favors = self.cursor.fetchone()[0]
+        """
+        Adds favors to (or, with a negative amount, removes them from) a user's wallet.
+        :return: None if successful, -1 if the user doesn't have a wallet
+        """
+        with self._cursor() as (cnx, cursor):
+            query_updateWallet = "UPDATE wallet SET cryptofavors = cryptofavors + %s WHERE userID = %s"
+            cursor.execute(query_updateWallet, (amount, userID))
 
-        # Check if the favors were retrieved correctly
-        if favors is None:
-            return -1
-        else:
-            favors += amount  # Update favors
-            query_updateWallet = "UPDATE wallet SET cryptofavors = %s WHERE userID = %s"
-            self.cursor.execute(query_updateWallet, (favors, userID))
-            self.cnx.commit()
+            # Check if the wallet was found
+            if cursor.rowcount == 0:
+                return -1
+            self._commit_wallets(cnx, [userID])
 
     def add_nomination(self, authorID: int, guildID: int, channelID: int, category: str,
                        messageID: int, message: str = None):
         """
         Adds the nomination to the database. Is this table super overcomplicated? Probably. But it works.
-        :return: True if successful, False otherwise
+        :return: True if successful, False otherwise, -1 if the message is already nominated for the category
         """
+        if self.is_nominated(guildID, messageID, category):
+            return -1
 
         print("Adding nomination...")
+        results = self._insert_nominations([(authorID, guildID, channelID, category, messageID, message)])
+        return False if results is None else results[0]
 
-        if message is not None:
-            # Prune string down to the first 255 characters or less to abide by SQL's VARCHAR limit
-            message = message[:255]
+    def add_nominations(self, nominations: list[tuple]) -> list | None:
+        """
+        Adds several nominations with one multi-row INSERT and a single commit. Duplicates are skipped.
+        :param nominations: Tuples in the same order as add_nomination's parameters:
+        [(authorID, guildID, channelID, category, messageID, message), ...]
+        :return: One result per nomination, in order: True if it was added, -1 if the message was already nominated
+        for the category (including earlier in the same list). None if the insert failed and nothing was added.
+        """
+        return self._insert_nominations(nominations)
 
-        # Create query
-        query_addNomination = ("INSERT INTO `nominations`(`authorID`, `guildID`, `channelID`, `messageID`, `message`,"
-                               "`category`) "
-                               "VALUES (%s,%s,%s,%s,%s,%s)")
+    @staticmethod
+    def _nomination_key(guildID: int, messageID: int, category: str) -> tuple[int, int, str]:
+        return int(guildID), int(messageID), category
 
+    def is_nominated(self, guildID: int, messageID: int, category: str) -> bool:
+        """
+        :return: Whether the message is already known to be nominated for the category. Doesn't touch the database,
+        so a False only means it hasn't been seen, not that it isn't there.
+        """
+        return self._nomination_key(guildID, messageID, category) in self._nominated
+
+    def _insert_nominations(self, nominations: list[tuple]) -> list | None:
+        """:return: True or -1 for each nomination (see add_nominations), or None if the insert failed"""
+        results = []
+        rows = {}  # Key -> row, for nominations that might be new
+        for authorID, guildID, channelID, category, messageID, message in nominations:
+            key = self._nomination_key(guildID, messageID, category)
+            if key in rows or key in self._nominated:
+                results.append(-1)  # Already saved, or earlier in this batch
+                continue
+            results.append(key)  # Filled in once we know whether it was saved
+
+            if message is not None:
+                # Prune string down to the first 255 characters or less to abide by SQL's VARCHAR limit
+                message = message[:255]
+            rows[key] = (authorID, guildID, channelID, messageID, message, category)
+        if not rows:
+            return results
+
+        query_addNominations = "INSERT IGNORE INTO `nominations`(`authorID`, `guildID`, `channelID`, `messageID`, " \
+                               "`message`, `category`) VALUES "
         try:
-            # Execute query
-            self.cursor.execute(query_addNomination, (authorID, guildID, channelID, messageID, message, category))
+            with self._cursor() as (cnx, cursor):
+                # The unique index on (guildID, messageID, category) decides what's a duplicate. There's no locking
+                # read first: on MySQL a SELECT ... FOR UPDATE of missing keys takes gap locks, which deadlock with
+                # the INSERT of a concurrent batch.
+                cursor.execute(query_addNominations + ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(rows)),
+                               tuple(value for row in rows.values() for value in row))
+                if cursor.rowcount == len(rows):
+                    added = set(rows)
+                else:
+                    # Some were already saved, but rowcount doesn't say which. Insert them one at a time instead,
+                    # which costs a round trip each, but only for batches that had a duplicate the filter missed.
+                    cnx.rollback()
+                    added = set()
+                    for key, row in rows.items():
+                        cursor.execute(query_addNominations + "(%s,%s,%s,%s,%s,%s)", row)
+                        if cursor.rowcount == 1:
+                            added.add(key)
+                cnx.commit()
+        except Exception as e:
+            print(f"Error adding nominations with messageIDs {[row[3] for row in rows.values()]}: {e}")
+            return None
 
-            # Check if the nomination was added by grabbing the last inserted ID and comparing
-            query_selectLast = "SELECT LAST_INSERT_ID()"
-            self.cursor.execute(query_selectLast)
+        with self._nominated_lock:
+            self._nominated.update(rows)
+        return [True if result in added else -1 for result in results]
 
-            # # Debugging
-            # result = self.cursor.fetchone()
-            # print(f"Nomination ID in SQLManager: {result[0]}")
-        except Exception as e:
-            print(f"Error adding nomination with messageID {messageID}: {e}")
-            return False
-        else:
-            self.cnx.commit()
-            return True
+    def warm_nomination_filter(self, shard_id: int = None, shard_count: int = 1) -> int:
+        """
+        Loads every saved nomination into the duplicate filter, so duplicates are caught without a database round
+        trip from then on.
+        :param shard_id: If given, only load guilds this shard handles
+        :param shard_count: Total number of shards
+        :return: Number of nominations loaded
+        """
+        shard, params = self._shard_filter(shard_id, shard_count)
+        keys = set()
+        with self._cursor(streaming=True, full_scan=True) as (cnx, cursor):
+            # Covered by the unique index, so this never has to read the nominations themselves
+            cursor.execute(f"SELECT guildID, messageID, category FROM nominations WHERE {shard}", params)
+            while True:
+                rows = cursor.fetchmany(10_000)
+                if not rows:
+                    break
+                # Every row shares one copy of each category name
+                keys.update(self._nomination_key(guildID, messageID, sys.intern(category))
+                            for guildID, messageID, category in rows)
+
+        with self._nominated_lock:
+            self._nominated |= keys  # Anything added while we were reading is kept too
+        return len(keys)
+
+    @staticmethod
+    def _nomination_filters(author_id: int | User = None, category: str = None, guild_id: int = None,
+                            channel_id: int = None, message_id: int = None) -> tuple[list[str], list]:
+        """:return: (conditions, params) that narrow nominations down to the ones matching every filter given"""
+        conditions = []
+        params = []
+        if guild_id is not None:
+            conditions.append("guildID = %s")
+            params.append(int(guild_id))
+        if channel_id is not None:
+            conditions.append("channelID = %s")
+            params.append(int(channel_id))
+        if message_id is not None:
+            conditions.append("messageID = %s")
+            params.append(int(message_id))
+        if author_id is not None:
+            if isinstance(author_id, User):
+                author_id = author_id.id
+
+            conditions.append("authorID = %s")
+            params.append(int(author_id))
+        if category is not None:
+            conditions.append("category = %s")
+            params.append(category)
+        return conditions, params
 
+    @_retry_reads
     def get_nomination(
             self, author_id: int | User = None, category: str = None,
-            guild_id: int = None, channel_id: int = None, message_id: int = None) -> list[tuple]:
+            guild_id: int = None, channel_id: int = None, message_id: int = None,
+            after_id: int = None, limit: int = None, fields: tuple[str, ...] = None) -> list[Nomination]:
         """
-        Gets select nominations from the database.
+        Gets select nominations from the database, oldest first.
 
         :param author_id: ID of the user who nominated the message. Should be a Snowflake type.
         :param category: Category of the nomination.
         :param guild_id: ID of the guild where the nomination was made. Can be a Snowflake (int) or a User type.
         :param channel_id: ID of the channel where the nomination was made. Should be in Snowflake format
         :param message_id: ID of the message that was nominated. Should be in Snowflake format.
-        :return: A list of tuples in the format of:
-        [(NominationID, GuildID, ChannelID, MessageID, AuthorID, Category, message), ...] or will return None.
+        :param after_id: Only return nominations with a NominationID greater than this. Pass the last NominationID
+        of the previous page to get the next one.
+        :param limit: Maximum number of nominations to return. None returns every match.
+        :param fields: Columns to fetch, e.g. ("nominationID", "message"). None fetches all of them.
+        :return: A list of Nominations, or rows with just the requested fields if fields was given
         """
+        row_type = Nomination if fields is None else projection(Nomination, tuple(fields))
 
         # Base query
-        query = "SELECT * FROM nominations WHERE 1"
+        query = f"SELECT {columns(row_type)} FROM nominations WHERE 1"
 
         # Conditions for optional parameters
-        conditions = []
-        if guild_id is not None:
-            conditions.append(f"guildID = {guild_id}")
-        if channel_id is not None:
-            conditions.append(f"channelID = {channel_id}")
-        if message_id is not None:
-            conditions.append(f"messageID = {message_id}")
-        if author_id is not None:
-            if author_id is User:
-                author_id = author_id.id
-
-            conditions.append(f"authorID = {author_id}")
-        if category is not None:
-            conditions.append(f"category = '{category}'")
+        conditions, params = self._nomination_filters(author_id, category, guild_id, channel_id, message_id)
+        if after_id is not None:
+            conditions.append("nominationID > %s")
+            params.append(int(after_id))
 
         # Combine conditions into the query
         if conditions:
             query += " AND " + " AND ".join(conditions)
 
+        # Walking the primary key means a page costs the same no matter how deep into the table it is
+        query += " ORDER BY nominationID"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(int(limit))
+
         # Execute the query
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(query, tuple(params))
+            return [row_type._make(row) for row in cursor.fetchall()]
+
+    @_retry_reads
+    def search_nominations(
+            self, text: str, author_id: int | User = None, category: str = None,
+            guild_id: int = None, channel_id: int = None,
+            offset: int = 0, limit: int = 10) -> list[Nomination]:
+        """
+        Full-text searches the messages of nominations, best matches first. Takes the same filters as get_nomination.
 
-    def get_categories(self) -> list:
-        query_getCategories = "SELECT * FROM categories"
-        self.cursor.execute(query_getCategories)
-        return self.cursor.fetchall()
+        :param text: Words to search for. Messages matching any of them are returned, ones matching more rank higher.
+        :param offset: Number of matches to skip, for paging
+        :param limit: Maximum number of nominations to return
+        :return: A list of Nominations
+        """
+        if not text.split():
+            return []
+
+        join, match, match_params, rank, rank_params = self.backend.match_nominations(text)
+        conditions, params = self._nomination_filters(author_id, category, guild_id, channel_id)
+
+        query = f"SELECT {columns(Nomination, 'n.')} FROM nominations n {join} WHERE " + \
+                " AND ".join([match] + conditions) + f" ORDER BY {rank}, n.nominationID LIMIT %s OFFSET %s"
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(query, (*match_params, *params, *rank_params, int(limit), int(offset)))
+            return [Nomination._make(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _shard_filter(shard_id: int = None, shard_count: int = 1) -> tuple[str, tuple]:
+        """:return: (condition, params) that only match guilds the given shard handles. Matches everything if None."""
+        if shard_id is None or shard_count <= 1:
+            return "1", ()
+        # Sharding.shard_for, done by the database. DMs are stored as guild 0, which lands on shard 0 like they do.
+        return "(guildID >> 22) % %s = %s", (int(shard_count), int(shard_id))
+
+    @_retry_reads
+    def count_nominations(self, shard_id: int = None, shard_count: int = 1,
+                          chunk_size: int = 10_000) -> tuple[int, ColumnSet]:
+        """
+        Counts every nomination, grouped finely enough to build any leaderboard from. Used to rebuild
+        NominationStats at startup. There's about one group per nomination, so the groups are streamed in and stored
+        by column rather than as a tuple each.
+        :param shard_id: If given, only count nominations in guilds this shard handles
+        :param shard_count: Total number of shards
+        :param chunk_size: Groups fetched from the database at a time
+        :return: The highest nominationID counted (0 if none), and a ColumnSet with the columns guildID, category,
+        channelID, messageID, authorID and count. Nominations with a higher ID aren't in the count.
+        """
+        shard, params = self._shard_filter(shard_id, shard_count)
+        query = f"SELECT guildID, category, channelID, messageID, authorID, COUNT(*) FROM nominations " \
+                f"WHERE nominationID <= %s AND {shard} GROUP BY guildID, category, channelID, messageID, authorID"
+        counts = ColumnSet(("guildID", "category", "channelID", "messageID", "authorID", "count"),
+                           integer=("guildID", "channelID", "messageID", "authorID", "count"))
+        with self._cursor(streaming=True, full_scan=True) as (cnx, cursor):
+            cursor.execute("SELECT MAX(nominationID) FROM nominations")
+            watermark = int(cursor.fetchone()[0] or 0)
+            cursor.execute(query, (watermark, *params))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return watermark, counts
+                counts.extend(rows)
+
+    @_retry_reads
+    def get_nomination_ids(self, keys: list[tuple[int, int, str]]) -> dict[tuple[int, int, str], int]:
+        """
+        :param keys: (guildID, messageID, category) of saved nominations
+        :return: Key -> nominationID, for each of the keys that's in the database
+        """
+        keys = list(dict.fromkeys(self._nomination_key(*key) for key in keys))
+        if not keys:
+            return {}
+        query = "SELECT guildID, messageID, category, nominationID FROM nominations " \
+                "WHERE (guildID, messageID, category) IN (" + ",".join(["(%s,%s,%s)"] * len(keys)) + ")"
+        with self._cursor() as (cnx, cursor):
+            cursor.execute(query, tuple(value for key in keys for value in key))
+            rows = cursor.fetchall()
+        return {self._nomination_key(guildID, messageID, category): int(nominationID)
+                for guildID, messageID, category, nominationID in rows}
+
+    def add_complaints(self, complaints: list[tuple]) -> bool:
+        """
+        Saves complaints with one multi-row INSERT and a single commit. Complaints that are already saved are skipped.
+        :param complaints: [(guildID, channelID, messageID, authorID, content), ...]
+        :return: True if successful, False otherwise
+        """
+        if not complaints:
+            return True
+        query_addComplaints = "INSERT IGNORE INTO `complaints`(`guildID`, `channelID`, `messageID`, `authorID`, " \
+                              "`content`) VALUES " + ",".join(["(%s,%s,%s,%s,%s)"] * len(complaints))
+        try:
+            with self._cursor() as (cnx, cursor):
+                cursor.execute(query_addComplaints, tuple(value for row in complaints for value in row))
+                cnx.commit()
+        except Exception as e:
+            print(f"Error saving {len(complaints)} complaints: {e}")
+            return False
+        else:
+            return True
+
+    def save_encounter(self, guildID: int, channelID: int, rolls: list[tuple[int | str, int]]) -> bool:
+        """
+        Replaces the saved initiative order of an encounter.
+        :param rolls: [(character, roll), ...] in initiative order. Characters are discord IDs for players and names
+        for NPC's. An empty list deletes the encounter.
+        :return: True if successful, False otherwise
+        """
+        query_deleteEncounter = "DELETE FROM initiative WHERE guildID = %s AND channelID = %s"
+        query_saveRolls = "INSERT INTO initiative(guildID, channelID, position, characterID, characterName, roll) " \
+                          "VALUES " + ",".join(["(%s,%s,%s,%s,%s,%s)"] * len(rolls))
+        params = []
+        for position, (character, roll) in enumerate(rolls):
+            if isinstance(character, int):
+                params += [guildID, channelID, position, int(character), None, roll]
+            else:
+                params += [guildID, channelID, position, None, character, roll]
+
+        try:
+            with self._cursor() as (cnx, cursor):
+                cursor.execute(query_deleteEncounter, (guildID, channelID))
+                if rolls:
+                    cursor.execute(query_saveRolls, tuple(params))
+                cnx.commit()
+        except Exception as e:
+            print(f"Error saving encounter in channel {channelID}: {e}")
+            return False
+        else:
+            return True
+
+    @_retry_reads
+    def get_encounters(self, shard_id: int = None, shard_count: int = 1) -> list[InitiativeRoll]:
+        """
+        :param shard_id: If given, only return encounters in guilds this shard handles
+        :param shard_count: Total number of shards
+        :return: Every saved initiative roll, in initiative order within each encounter
+        """
+        shard, params = self._shard_filter(shard_id, shard_count)
+        query_getEncounters = f"SELECT guildID, channelID, characterID, characterName, roll FROM initiative " \
+                              f"WHERE {shard} ORDER BY guildID, channelID, position"
+        with self._cursor(full_scan=True) as (cnx, cursor):
+            cursor.execute(query_getEncounters, params)
+            return [InitiativeRoll(guildID, channelID, characterID if characterID is not None else characterName, roll)
+                    for guildID, channelID, characterID, characterName, roll in cursor.fetchall()]
+
+    def export_rows(self, table: str, chunk_size: int = 1000):
+        """
+        Reads a whole table a chunk at a time, so memory use doesn't depend on how big the table is. Keeps a pooled
+        connection checked out until the generator is used up or closed.
+
+        :param table: One of EXPORTABLE_TABLES
+        :param chunk_size: Rows per chunk
+        :return: A generator of lists of up to chunk_size rows, in the order of EXPORTABLE_TABLES[table]
+        """
+        if table not in EXPORTABLE_TABLES:
+            raise ValueError(f"Can't export {table}. Pick one of: {', '.join(EXPORTABLE_TABLES)}")
+
+        fields = EXPORTABLE_TABLES[table]
+        query = f"SELECT {', '.join(fields)} FROM {table} ORDER BY {fields[0]}"
+        with self._cursor(streaming=True, full_scan=True) as (cnx, cursor):
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield rows
+
+    @_retry_reads
+    def get_categories(self) -> list[Category]:
+        query_getCategories = f"SELECT {columns(Category)} FROM categories"
+        with self._cursor(full_scan=True) as (cnx, cursor):
+            cursor.execute(query_getCategories)
+            return [Category._make(row) for row in cursor.fetchall()]
 
     def close(self):
-        """Closes the connection"""
+        """Closes every connection in the pool"""
 
         print("Closing Connection")
-        self.cursor.close()
-        self.cnx.close()
+        self._pool.close()
         print("Connection Closed")
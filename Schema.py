@@ -0,0 +1,343 @@
+"""Creates the database's tables and indexes, and keeps them up to date. The schema is a list of numbered migrations,
+and the database records which ones it has had in its schema_version table. The bot applies any that are missing once
+at startup (unless SQL_AUTO_MIGRATE is off), so a new database is set up and an old one is brought up to date just by
+starting it.
+
+Each migration is written for every backend, since the engines disagree on column types and full-text search.
+Migrations are only ever added to the end of the list. Changing one that has shipped does nothing to the databases
+that already have it. None of them deletes data on its own: one that would have to refuses to run, and says which
+flag to run this script with to allow it.
+
+check_plans() asks the database how it runs every query SQLManager has sent, and flags the ones that read a whole
+table. Queries that are meant to read everything (exports, startup loads) aren't checked.
+
+Usage:
+    python Schema.py                        Applies any missing migrations
+    python Schema.py --delete-duplicates    Also deletes all but the first of each duplicated nomination, which has
+                                            to happen once before an old database can get the unique index
+    python Schema.py --check                Also runs the bot's common reads and reports any that scan a whole table
+"""
+import argparse
+from typing import NamedTuple
+
+from SQLBackend import SQLBackend
+
+
+class Index(NamedTuple):
+    table: str
+    name: str
+    columns: tuple[str, ...]
+    unique: bool = False
+    fulltext: bool = False  # MySQL only
+
+    def create(self) -> str:
+        kind = "UNIQUE " if self.unique else "FULLTEXT " if self.fulltext else ""
+        return f"CREATE {kind}INDEX {self.name} ON {self.table} ({', '.join(self.columns)})"
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    steps: dict  # Backend name -> SQL statements, Indexes and checks (called with the cursor), run in order
+
+
+_MYSQL_TABLES = [
+    """CREATE TABLE IF NOT EXISTS users (
+        userID BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+        nickname VARCHAR(255)
+    )""",
+    """CREATE TABLE IF NOT EXISTS wallet (
+        userID BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+        cryptofavors INT NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS transactions (
+        transactionID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        sender BIGINT UNSIGNED NOT NULL,
+        receiver BIGINT UNSIGNED NOT NULL,
+        amount INT NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'PENDING',
+        created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        completed TIMESTAMP NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS nominations (
+        nominationID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+        guildID BIGINT UNSIGNED NOT NULL,
+        channelID BIGINT UNSIGNED NOT NULL,
+        messageID BIGINT UNSIGNED NOT NULL,
+        authorID BIGINT UNSIGNED NOT NULL,
+        category VARCHAR(64) NOT NULL,
+        message TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS categories (
+        name VARCHAR(64) NOT NULL PRIMARY KEY
+    )""",
+    """CREATE TABLE IF NOT EXISTS initiative (
+        guildID BIGINT UNSIGNED NOT NULL,
+        channelID BIGINT UNSIGNED NOT NULL,
+        position INT NOT NULL,
+        characterID BIGINT UNSIGNED,
+        characterName VARCHAR(255),
+        roll INT NOT NULL,
+        PRIMARY KEY (guildID, channelID, position)
+    )""",
+]
+
+_SQLITE_TABLES = [
+    """CREATE TABLE IF NOT EXISTS users (
+        userID INTEGER PRIMARY KEY,
+        nickname TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS wallet (
+        userID INTEGER PRIMARY KEY,
+        cryptofavors INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS transactions (
+        transactionID INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender INTEGER NOT NULL,
+        receiver INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'PENDING',
+        created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        completed TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS nominations (
+        nominationID INTEGER PRIMARY KEY AUTOINCREMENT,
+        guildID INTEGER NOT NULL,
+        channelID INTEGER NOT NULL,
+        messageID INTEGER NOT NULL,
+        authorID INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        message TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS categories (
+        name TEXT PRIMARY KEY
+    )""",
+    """CREATE TABLE IF NOT EXISTS initiative (
+        guildID INTEGER NOT NULL,
+        channelID INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        characterID INTEGER,
+        characterName TEXT,
+        roll INTEGER NOT NULL,
+        PRIMARY KEY (guildID, channelID, position)
+    )""",
+]
+
+_COUNT_DUPLICATE_NOMINATIONS = """
+    SELECT COALESCE(SUM(copies - 1), 0) FROM (
+        SELECT COUNT(*) AS copies FROM nominations GROUP BY guildID, messageID, category HAVING COUNT(*) > 1
+    ) AS duplicates"""
+
+# The extra derived table is there because MySQL won't delete from a table that the subquery reads directly
+_DELETE_DUPLICATE_NOMINATIONS = """
+    DELETE FROM nominations WHERE nominationID NOT IN (
+        SELECT nominationID FROM (
+            SELECT MIN(nominationID) AS nominationID FROM nominations GROUP BY guildID, messageID, category
+        ) AS first_nominations
+    )"""
+
+
+class DuplicateNominations(Exception):
+    """Raised when the unique index can't be made because some messages are nominated more than once"""
+
+
+def _duplicate_nominations(cursor, delete_duplicates: bool):
+    """
+    Databases from before duplicates were blocked have to lose them before the unique index can be made. That's
+    somebody's data, so it's only deleted when asked for.
+    """
+    cursor.execute(_COUNT_DUPLICATE_NOMINATIONS)
+    duplicates = int(cursor.fetchone()[0])
+    if not duplicates:
+        return
+    if not delete_duplicates:
+        raise DuplicateNominations(f"{duplicates} nominations are duplicates of an earlier one for the same message "
+                                   f"and category. Run python Schema.py --delete-duplicates to delete them (keeping "
+                                   f"the first of each), or remove them by hand.")
+    cursor.execute(_DELETE_DUPLICATE_NOMINATIONS)
+    print(f"Deleted {duplicates} duplicate nominations")
+
+# Every nomination listing filters on some of guildID, channelID, authorID and category and walks the primary key.
+# Both engines keep the primary key at the end of a secondary index, so equality on the leading columns comes out
+# already in nominationID order.
+_HOT_INDEXES = [
+    # A message can only be nominated once per category. Also serves lookups by guild.
+    Index("nominations", "nominations_unique", ("guildID", "messageID", "category"), unique=True),
+    Index("nominations", "nominations_guild_category", ("guildID", "category")),
+    Index("nominations", "nominations_author_category", ("authorID", "category")),
+    Index("nominations", "nominations_category", ("category",)),
+    Index("nominations", "nominations_channel", ("channelID",)),
+    # Lets the sweeper find stale transactions without scanning the table
+    Index("transactions", "transactions_status_created", ("status", "created")),
+]
+
+_SQLITE_SEARCH = [
+    # Full-text index over nomination messages, kept up to date by the triggers below
+    """CREATE VIRTUAL TABLE IF NOT EXISTS nominations_fts USING fts5(
+        message, content='nominations', content_rowid='nominationID'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS nominations_fts_insert AFTER INSERT ON nominations BEGIN
+        INSERT INTO nominations_fts(rowid, message) VALUES (new.nominationID, new.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nominations_fts_delete AFTER DELETE ON nominations BEGIN
+        INSERT INTO nominations_fts(nominations_fts, rowid, message) VALUES ('delete', old.nominationID, old.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS nominations_fts_update AFTER UPDATE OF message ON nominations BEGIN
+        INSERT INTO nominations_fts(nominations_fts, rowid, message) VALUES ('delete', old.nominationID, old.message);
+        INSERT INTO nominations_fts(rowid, message) VALUES (new.nominationID, new.message);
+    END""",
+    # Index the messages that were saved before the triggers existed
+    "INSERT INTO nominations_fts(nominations_fts) VALUES ('rebuild')",
+]
+
+_COMPLAINTS = {
+    "mysql": [
+        """CREATE TABLE IF NOT EXISTS complaints (
+            complaintID INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            guildID BIGINT UNSIGNED NOT NULL,
+            channelID BIGINT UNSIGNED NOT NULL,
+            messageID BIGINT UNSIGNED NOT NULL,
+            authorID BIGINT UNSIGNED NOT NULL,
+            content TEXT,
+            created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+    "sqlite": [
+        """CREATE TABLE IF NOT EXISTS complaints (
+            complaintID INTEGER PRIMARY KEY AUTOINCREMENT,
+            guildID INTEGER NOT NULL,
+            channelID INTEGER NOT NULL,
+            messageID INTEGER NOT NULL,
+            authorID INTEGER NOT NULL,
+            content TEXT,
+            created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+}
+# A complaint is only filed once, even if its batch is retried
+_COMPLAINTS_UNIQUE = Index("complaints", "complaints_message", ("messageID",), unique=True)
+
+MIGRATIONS = [
+    Migration(1, "Create the tables", {
+        "mysql": _MYSQL_TABLES,
+        "sqlite": _SQLITE_TABLES,
+    }),
+    Migration(2, "Index the nomination filters, duplicate check and stale transaction sweep", {
+        "mysql": [_duplicate_nominations, *_HOT_INDEXES],
+        "sqlite": [_duplicate_nominations, *_HOT_INDEXES],
+    }),
+    Migration(3, "Full-text search over nomination messages", {
+        "mysql": [Index("nominations", "ft_nominations_message", ("message",), fulltext=True)],
+        "sqlite": _SQLITE_SEARCH,
+    }),
+    Migration(4, "Complaints filed in the HR channels", {
+        "mysql": [*_COMPLAINTS["mysql"], _COMPLAINTS_UNIQUE],
+        "sqlite": [*_COMPLAINTS["sqlite"], _COMPLAINTS_UNIQUE],
+    }),
+]
+
+LATEST = MIGRATIONS[-1].version
+
+_VERSION_TABLE = "CREATE TABLE IF NOT EXISTS schema_version (version INT NOT NULL PRIMARY KEY, " \
+                 "description VARCHAR(255) NOT NULL, applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+
+
+def migrate(backend: SQLBackend, cnx, delete_duplicates: bool = False) -> list[int]:
+    """
+    Applies every migration the database doesn't have yet, oldest first. Each one is committed (and recorded) on its
+    own, so a failure part way through leaves the database at the last version that finished.
+
+    :param backend: Backend the connection belongs to
+    :param cnx: A connection of the backend's own, not a pooled one
+    :param delete_duplicates: If True, duplicate nominations in the way of the unique index are deleted. Otherwise
+    DuplicateNominations is raised and the database stays at the version before.
+    :return: Versions that were applied. Empty if the database was already up to date.
+    """
+    cursor = backend.cursor(cnx)
+    try:
+        cursor.execute(_VERSION_TABLE)
+        cnx.commit()
+        backend.lock_schema(cursor)  # Other shards starting at the same time wait here, then find nothing to do
+        try:
+            cursor.execute("SELECT version FROM schema_version")
+            done = {int(version) for version, in cursor.fetchall()}
+
+            applied = []
+            for migration in MIGRATIONS:
+                if migration.version in done:
+                    continue
+                print(f"Migrating the database to schema version {migration.version}: {migration.description}")
+                for step in migration.steps[backend.name]:
+                    if callable(step):
+                        step(cursor, delete_duplicates)
+                        continue
+                    if isinstance(step, Index):
+                        if backend.has_index(cursor, step.table, step.name):
+                            continue  # Made by hand before migrations existed
+                        step = step.create()
+                    cursor.execute(step)
+                cursor.execute("INSERT IGNORE INTO schema_version(version, description) VALUES (%s, %s)",
+                               (migration.version, migration.description))
+                cnx.commit()
+                applied.append(migration.version)
+            return applied
+        finally:
+            backend.unlock_schema(cursor)
+    finally:
+        cursor.close()
+
+
+def check_plans(database) -> list[tuple[str, list[str]]]:
+    """
+    Explains every query the database manager has sent so far, and finds the ones that read a whole table.
+    :param database: SQLManager whose queries to check. This blocks, so run it on the database thread pool from the bot.
+    :return: (normalized query, tables it reads in full) for each query that scans, slowest total first
+    """
+    scans = []
+    for statement, (query, params) in database.metrics.samples().items():
+        if statement.split()[0].upper() not in ("SELECT", "UPDATE", "DELETE"):
+            continue  # Inserts and schema changes don't look anything up
+        tables = database.full_scans(query, params)
+        if tables:
+            scans.append((statement, tables))
+    return scans
+
+
+def _exercise(database):
+    """Runs every read the bot does on a hot path, so check_plans has something to look at outside of the bot"""
+    database.get_wallet(0)
+    database.get_transaction(0)
+    for filters in ({"author_id": 0}, {"category": ""}, {"author_id": 0, "category": ""},
+                    {"guild_id": 0, "category": ""}, {"guild_id": 0, "message_id": 0}, {"channel_id": 0}):
+        database.get_nomination(**filters, after_id=0, limit=6)
+    database.search_nominations("nakamoto", guild_id=0)
+    database.search_nominations("nakamoto", author_id=0, category="")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delete-duplicates", action="store_true",
+                        help="Delete duplicate nominations so the unique index can be made")
+    parser.add_argument("--check", action="store_true", help="Report common queries that scan a whole table")
+    args = parser.parse_args()
+
+    from SQLManager import SQLManager  # SQLManager imports this module, so wait until it's needed
+
+    database = SQLManager(pool_size=1, lazy=False)
+    try:
+        database.migrate(delete_duplicates=args.delete_duplicates)
+        print(f"Database is at schema version {database.schema_version()} of {LATEST}")
+        if not args.check:
+            return
+
+        _exercise(database)
+        scans = check_plans(database)
+        for statement, tables in scans:
+            print(f"Scans {', '.join(tables)}: {statement}")
+        print(f"{len(scans)} of {len(database.metrics.samples())} queries scan a whole table")
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
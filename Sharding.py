@@ -0,0 +1,22 @@
+"""Which guilds this process is responsible for when the bot runs as several shards (see Supervisor.py). Discord sends
+each guild's events to exactly one shard, and DMs always go to shard 0.
+
+The shard is picked with NAKAMOTO_SHARD_ID and NAKAMOTO_SHARD_COUNT in the environment. The supervisor sets both; a
+bot started on its own is shard 0 of 1, which owns every guild."""
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SHARD_ID = int(os.getenv("NAKAMOTO_SHARD_ID", 0))
+SHARD_COUNT = int(os.getenv("NAKAMOTO_SHARD_COUNT", 1))
+
+
+def shard_for(guild_id: int | None, shard_count: int = SHARD_COUNT) -> int:
+    """:return: The shard Discord sends the guild's events to. Same formula as Discord's."""
+    return (int(guild_id or 0) >> 22) % shard_count
+
+
+def owns(guild_id: int | None) -> bool:
+    """:return: Whether this process is the one handling the guild"""
+    return shard_for(guild_id) == SHARD_ID
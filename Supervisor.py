@@ -0,0 +1,122 @@
+"""Runs the bot as several processes, one gateway shard each, so guilds are spread across cores instead of sharing a
+single event loop. Every worker is a normal main.py with its own connection pool; the supervisor only starts them,
+restarts any that crash, and stops them all together.
+
+Usage:
+    python Supervisor.py --shards 4
+
+Shards are started a few seconds apart, since Discord only lets a bot identify one shard at a time. If a worker exits
+cleanly (e.g. after /admin shutdown), the supervisor takes that as a request to stop the whole bot.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+_HEALTHY_AFTER = 60  # Seconds a worker has to stay up before a crash stops counting against it
+_MAX_BACKOFF = 60  # Longest wait before restarting a worker that keeps crashing, in seconds
+
+
+class Worker:
+
+    def __init__(self, shard_id: int, shard_count: int):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0.0
+        self.failures = 0  # Crashes in a row, used for the restart backoff
+        self.restart_at = 0.0
+
+    def start(self):
+        env = dict(os.environ, NAKAMOTO_SHARD_ID=str(self.shard_id), NAKAMOTO_SHARD_COUNT=str(self.shard_count))
+        self.process = subprocess.Popen([sys.executable, _MAIN], env=env)
+        self.started = time.monotonic()
+        print(f"Supervisor: started shard {self.shard_id} (PID {self.process.pid})")
+
+    def crashed(self, code: int):
+        """Schedules a restart, backing off further the more often the worker has crashed in a row"""
+        if time.monotonic() - self.started > _HEALTHY_AFTER:
+            self.failures = 0
+        delay = min(_MAX_BACKOFF, 2 ** self.failures)
+        self.failures += 1
+        self.process = None
+        self.restart_at = time.monotonic() + delay
+        print(f"Supervisor: shard {self.shard_id} exited with code {code}, restarting in {delay}s")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()  # main.py saves what it has to and logs out on SIGTERM
+
+
+def run(shard_count: int, stagger: float = 5.0, poll: float = 1.0, stop_timeout: float = 30.0):
+    """
+    Starts every shard and keeps them running until asked to stop.
+    :param shard_count: Number of shards, and so worker processes
+    :param stagger: Seconds between starting one shard and the next
+    :param poll: Seconds between checks on the workers
+    :param stop_timeout: Seconds to wait for workers to shut down cleanly before killing them
+    """
+    workers = [Worker(shard_id, shard_count) for shard_id in range(shard_count)]
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        print(f"Supervisor: got signal {signum}, stopping every shard")
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    now = time.monotonic()
+    for worker in workers:
+        worker.restart_at = now + worker.shard_id * stagger
+
+    while not stopping:
+        for worker in workers:
+            if worker.process is None:
+                if time.monotonic() >= worker.restart_at:
+                    worker.start()
+                continue
+
+            code = worker.process.poll()
+            if code == 0:
+                print(f"Supervisor: shard {worker.shard_id} shut down, stopping every shard")
+                worker.process = None
+                stopping = True
+                break
+            elif code is not None:
+                worker.crashed(code)
+        time.sleep(poll)
+
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + stop_timeout
+    for worker in workers:
+        if worker.process is None:
+            continue
+        try:
+            worker.process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"Supervisor: shard {worker.shard_id} didn't stop in time, killing it")
+            worker.process.kill()
+    print("Supervisor: every shard stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=int(os.getenv("NAKAMOTO_SHARD_COUNT", os.cpu_count() or 1)),
+                        help="Number of shards to run. Defaults to NAKAMOTO_SHARD_COUNT, or one per core.")
+    parser.add_argument("--stagger", type=float, default=5.0, help="Seconds between starting each shard")
+    args = parser.parse_args()
+    run(args.shards, args.stagger)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Cancels transactions that have been pending for too long and refunds their senders, so abandoned transfers don't
+keep favors in limbo forever. Runs in the background on the bot's event loop, a batch at a time, and backs off whenever
+commands need the database."""
+import asyncio
+import time
+
+
+class TransactionSweeper:
+
+    def __init__(self, database, max_age: float = 86400, interval: float = 600, batch_size: int = 200,
+                 batch_pause: float = 1.0):
+        """
+        :param database: AsyncSQLManager to sweep
+        :param max_age: Seconds a transaction can stay pending before it's cancelled
+        :param interval: Seconds between sweeps
+        :param batch_size: Most transactions cancelled per database transaction
+        :param batch_pause: Seconds to wait between batches, so a big backlog is cleared out gradually
+        """
+        self.database = database
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+
+        # Statistics
+        self.sweeps = 0
+        self.cancelled = 0
+        self.refunded = 0
+        self.last_sweep = None  # time.time() of the last finished sweep
+
+    def _busy(self) -> bool:
+        """:return: Whether commands are using (or waiting for) most of the database connections"""
+        stats = self.database.stats()
+        return stats["queued"] > 0 or stats["in_use"] >= max(1, stats["size"] - 1)
+
+    async def sweep(self) -> tuple[int, int]:
+        """
+        Cancels every transaction that's been pending longer than max_age.
+        :return: (transactions cancelled, favors refunded)
+        """
+        cancelled = refunded = 0
+        senders = set()
+        while True:
+            while self._busy():
+                await asyncio.sleep(self.batch_pause)  # Commands come first
+
+            stale = await self.database.cancel_stale_transactions(self.max_age, self.batch_size)
+            cancelled += len(stale)
+            refunded += sum(int(t.amount) for t in stale)
+            senders.update(int(t.sender) for t in stale)
+            if len(stale) < self.batch_size:
+                break
+            await asyncio.sleep(self.batch_pause)
+
+        self.sweeps += 1
+        self.cancelled += cancelled
+        self.refunded += refunded
+        self.last_sweep = time.time()
+        if cancelled:
+            print(f"Swept {cancelled} stale transactions, refunding {refunded} favors to {len(senders)} senders")
+        return cancelled, refunded
+
+    async def run(self):
+        """Sweeps every interval seconds, forever. Meant to be run as a background task."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print(f"Error sweeping stale transactions: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "sweeps": self.sweeps,
+            "cancelled": self.cancelled,
+            "refunded": self.refunded,
+            "last_sweep": self.last_sweep,
+        }
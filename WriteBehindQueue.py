@@ -0,0 +1,112 @@
+"""Batches up writes so a burst of them shares one commit. Callers still get to wait until their row is actually
+saved, they just share the trip to the database with everyone else who wrote around the same time."""
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+
+class WriteBehindQueue:
+
+    def __init__(self, flush: Callable[[list], Awaitable[bool]], max_batch: int = 100, interval: float = 0.05,
+                 max_pending: int = 1000):
+        """
+        :param flush: Coroutine that writes a list of rows in one transaction. Returns whether it worked, or a list
+        with each row's own result, in order (None counts as a failure)
+        :param max_batch: Most rows written in a single flush
+        :param interval: Longest a row waits (in seconds) for more rows to join its batch
+        :param max_pending: Most rows that can be waiting at once. Writers have to wait for room past this.
+        """
+        self._flush = flush
+        self.max_batch = max_batch
+        self.interval = interval
+
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._worker = None
+        self._closed = False
+
+        # Statistics
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_rows = 0
+
+    async def submit(self, row) -> bool:
+        """
+        Queues a row and waits for it to be written. Waits for room first if the queue is full.
+        :return: True if the row was saved, False otherwise, or the row's own result if flush gives one per row
+        """
+        return await (await self.put(row))
+
+    async def put(self, row) -> asyncio.Future:
+        """
+        Queues a row without waiting for it to be written. Waits for room first if the queue is full.
+        :return: Future that gets the row's result (see submit) once it's written
+        """
+        if self._closed:
+            raise RuntimeError("Write-behind queue is closed")
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Give other writers until the deadline to join this batch
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._write(batch)
+
+    async def _write(self, batch: list):
+        try:
+            results = await self._flush([row for row, _ in batch])
+        except Exception as e:
+            print(f"Error flushing {len(batch)} queued writes: {e}")
+            results = False
+        if not isinstance(results, list):
+            results = [bool(results)] * len(batch)
+
+        self.flushes += 1
+        failed = results.count(False)
+        self.rows_written += len(batch) - failed
+        self.failed_rows += failed
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+            self._queue.task_done()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def flush(self):
+        """Waits until every row queued so far has been written"""
+        if self._worker is not None:
+            await self._queue.join()
+
+    async def close(self):
+        """Stops taking new rows, writes everything still queued, then stops the background task"""
+        self._closed = True
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failed_rows": self.failed_rows,
+        }
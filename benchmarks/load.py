@@ -0,0 +1,245 @@
+"""Load generator for the bot's commands and SQLManager. Drives the real command coroutines from main.py with a fake
+Discord context and an embedded SQLite database, then reports throughput and p50/p95/p99 latency for each one.
+
+Run it from the repository root with `python -m benchmarks.load`. Nothing touches Discord or the MySQL server: the
+database is a throwaway SQLite file, and the client's API lookups are replaced with fakes that take --api-latency-ms.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+CATEGORIES = ["Worst Idea", "Best Idea", "Biggest Lie", "Worst Bit", "Best Bit", "Least Funny Recurring Joke",
+              "Craziest Working Gaslight", "Funniest Recurring Joke", "Dumbest Discussion"]
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, content: str = ""):
+        self.id = message_id
+        self.content = content
+
+    async def edit(self, **kwargs):
+        return self
+
+
+class FakeContext:
+    """Just enough of a SlashContext / ContextMenuContext for the commands to run."""
+
+    def __init__(self, bot, user_id: int, guild_id: int, channel_id: int, target: FakeMessage = None):
+        self.bot = bot
+        self.author = SimpleNamespace(id=user_id, username=f"user{user_id}", display_name=f"User {user_id}")
+        self.author_id = user_id
+        self.guild = SimpleNamespace(id=guild_id)
+        self.guild_id = guild_id
+        self.channel = SimpleNamespace(id=channel_id)
+        self.channel_id = channel_id
+        self.target = target
+        self.responded = False
+        self.deferred = False
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.responded = True
+        self.sent.append(content if content is not None else kwargs)
+        return FakeMessage(random.getrandbits(60))
+
+    async def defer(self, **kwargs):
+        self.deferred = True
+
+    async def send_modal(self, modal):
+        self.responded = True
+
+
+class FakeBot:
+    """Stands in for ctx.bot: answers modals with a random category, and nobody ever clicks a pager button."""
+
+    def __init__(self, modal_context):
+        self._modal_context = modal_context
+
+    async def wait_for_modal(self, modal, *args, **kwargs):
+        return self._modal_context()
+
+    async def wait_for_component(self, *args, **kwargs):
+        raise asyncio.TimeoutError
+
+
+def seed(path: str, guilds: int, users: int, nominations: int):
+    """Fills a fresh SQLite database with categories, users, wallets and nominations."""
+    from SQLManager import SQLManager
+    from SQLBackend import SQLiteBackend
+
+    database = SQLManager(pool_size=1, backend=SQLiteBackend(path))
+    database.migrate()
+    database.sync_users(SimpleNamespace(id=u, username=f"user{u}") for u in range(1, users + 1))
+    with database._cursor() as (cnx, cursor):
+        for category in CATEGORIES:
+            cursor.execute("INSERT IGNORE INTO categories(name) VALUES (%s)", (category,))
+        cnx.commit()
+
+    rows = [(random.randint(1, users), random.randint(1, guilds), random.randint(1, guilds * 4),
+             random.choice(CATEGORIES), 10_000_000 + i, f"Nominated message number {i}") for i in range(nominations)]
+    for start in range(0, len(rows), 500):
+        database.add_nominations(rows[start:start + 500])
+    database.close()
+
+
+def patch_api(bot, latency: float):
+    """Replaces the client's cache and API lookups with fakes, so lookups cost `latency` seconds and nothing else."""
+    async def fetch(entity_id, *args, **kwargs):
+        await asyncio.sleep(latency)
+        return SimpleNamespace(id=entity_id, name=f"entity-{entity_id}", display_name=f"User {entity_id}")
+
+    for kind in ("user", "guild", "channel"):
+        setattr(bot, f"get_{kind}", lambda entity_id: None)
+        setattr(bot, f"fetch_{kind}", fetch)
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if len(latencies) < 2:
+        latency = latencies[0] if latencies else 0.0
+        return {"p50": latency, "p95": latency, "p99": latency}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+async def measure(name: str, make_call, requests: int, concurrency: int) -> dict:
+    """
+    Runs make_call() `requests` times, `concurrency` at a time.
+    :param make_call: Function that returns a fresh coroutine for one request
+    :return: Throughput and latency numbers (in milliseconds)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await make_call()
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"  {name} failed: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        **{k: v * 1000 for k, v in percentiles(latencies).items()},
+    }
+    print(f"{name:<28} {result['throughput']:9.1f} req/s   p50 {result['p50']:8.2f}ms   "
+          f"p95 {result['p95']:8.2f}ms   p99 {result['p99']:8.2f}ms   errors {errors}")
+    return result
+
+
+async def run(args) -> dict:
+    import main  # Imported here, once the environment points it at the seeded database
+
+    patch_api(main.bot, args.api_latency_ms / 1000)
+    database = main.database
+    await main.categories.reload(database)  # Normally done in the background once the bot logs in
+    await main.nomination_stats.load(database)
+
+    def user():
+        return random.randint(1, args.users)
+
+    def context(**kwargs) -> FakeContext:
+        return FakeContext(FakeBot(modal_context), user(), random.randint(1, args.guilds),
+                           random.randint(1, args.guilds * 4), **kwargs)
+
+    def modal_context() -> FakeContext:
+        modal_ctx = FakeContext(None, 0, 0, 0)
+        modal_ctx.responses = {"category": random.choice(CATEGORIES).lower()}
+        return modal_ctx
+
+    message_ids = iter(range(90_000_000, 2 ** 62))
+    cases = {
+        "command:get_nominations": lambda: main.get_nominations.callback(context()),
+        "command:get_nominations(cat)": lambda: main.get_nominations.callback(
+            context(), category=random.choice(CATEGORIES)),
+        "command:nominate": lambda: main.nominate.callback(
+            context(target=FakeMessage(next(message_ids), "A message worth nominating"))),
+        "command:search_nominations": lambda: main.search_nominations.callback(
+            context(), f"number {random.randrange(args.nominations)}"),
+        "command:nominations_stats": lambda: main.nominations_stats.callback(context()),
+        "command:nominations_top": lambda: main.nominations_top.callback(
+            context(), random.choice(["messages", "nominators"])),
+        "command:initiative_roll": lambda: main.initiative_roll.callback(context(), random.randint(1, 20)),
+        "command:initiative_get_order": lambda: main.initiative_get_order.callback(context()),
+        "command:dbtest": lambda: main.dbtest.callback(context()),
+        "sql:get_wallet": lambda: database.get_wallet(user()),
+        "sql:get_nomination(page)": lambda: database.get_nomination(
+            guild_id=random.randint(1, args.guilds), limit=6),
+        "sql:search_nominations": lambda: database.search_nominations(
+            f"number {random.randrange(args.nominations)}", guild_id=random.randint(1, args.guilds), limit=6),
+        "sql:add_nomination": lambda: database.add_nomination(
+            user(), 1, 1, random.choice(CATEGORIES), next(message_ids), "benchmark"),
+        "sql:transfer": lambda: transfer(database, user(), user()),
+    }
+
+    results = {}
+    for name, make_call in cases.items():
+        if args.only and not any(o in name for o in args.only):
+            continue
+        results[name] = await measure(name, make_call, args.requests, args.concurrency)
+
+    await main.tracker.flush()
+    await database.shutdown()
+    return results
+
+
+async def transfer(database, sender: int, receiver: int):
+    transaction_id = await database.add_transaction(sender, receiver, 1)
+    await database.confirm_transaction(transaction_id, sender)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per command")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--nominations", type=int, default=20_000, help="Nominations seeded before the run")
+    parser.add_argument("--api-latency-ms", type=float, default=50, help="Simulated Discord API round trip")
+    parser.add_argument("--only", nargs="*", help="Only run cases whose name contains one of these")
+    parser.add_argument("--output", default="bench_output.json", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        os.environ["SQL_BACKEND"] = "sqlite"
+        os.environ["SQLITE_PATH"] = path
+        os.environ["CATEGORY_SNAPSHOT_PATH"] = os.path.join(directory, "categories.json")
+        os.environ.setdefault("SQL_POOL_SIZE", str(args.concurrency))
+
+        print(f"Seeding {args.nominations} nominations across {args.guilds} guilds...")
+        seed(path, args.guilds, args.users, args.nominations)
+        results = asyncio.run(run(args))
+
+    report = {
+        "settings": {k: v for k, v in vars(args).items() if k != "output"},
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
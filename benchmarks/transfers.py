@@ -0,0 +1,97 @@
+"""Measures how many favor transfers per second the database can settle, comparing the old read-modify-write path to
+the single-transaction ledger path and the batch API.
+
+Run it from the repository root with `python -m benchmarks.transfers`. It writes to whatever database the .env points
+at, using two wallets with IDs that no real Discord user can have, so point it at a test database.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from SQLManager import SQLManager
+
+SENDER = 1
+RECEIVER = 2
+
+
+def setup_wallets(database: SQLManager):
+    with database._cursor() as (cnx, cursor):
+        for userID in (SENDER, RECEIVER):
+            cursor.execute("INSERT IGNORE INTO users(userID, nickname) VALUES (%s, %s)", (userID, "benchmark"))
+            cursor.execute("INSERT IGNORE INTO wallet(userID) VALUES (%s)", (userID,))
+        cnx.commit()
+
+
+def cleanup(database: SQLManager):
+    with database._cursor() as (cnx, cursor):
+        cursor.execute("DELETE FROM transactions WHERE sender = %s", (SENDER,))
+        cnx.commit()
+
+
+def legacy_confirm(database: SQLManager, transaction_id: int, userID: int):
+    """The settlement path as it was before the ledger engine: six round trips and two commits per transfer."""
+    with database._cursor() as (cnx, cursor):
+        cursor.execute("SELECT * FROM transactions WHERE transactionID=%s", (transaction_id,))
+        transaction = cursor.fetchone()
+        if transaction is None or int(transaction[1]) != userID or transaction[4] != "PENDING":
+            return -1
+
+        cursor.execute("SELECT CURRENT_TIMESTAMP()")
+        timestamp = cursor.fetchone()[0]
+        cursor.execute("UPDATE transactions SET status = %s, completed = %s WHERE transactionID = %s",
+                       ("COMPLETED", timestamp, transaction_id))
+        cnx.commit()
+
+    with database._cursor() as (cnx, cursor):
+        cursor.execute("SELECT cryptofavors FROM wallet WHERE userID=%s", (transaction[2],))
+        favors = cursor.fetchone()[0] + transaction[3]
+        cursor.execute("UPDATE wallet SET cryptofavors = %s WHERE userID = %s", (favors, transaction[2]))
+        cnx.commit()
+
+
+def run(name: str, database: SQLManager, transfers: int, concurrency: int, settle) -> float:
+    """
+    Creates a batch of pending transactions, then times settle() on them.
+    :param settle: Function that takes the list of transaction IDs and settles all of them
+    :return: Transfers per second
+    """
+    ids = [database.add_transaction(SENDER, RECEIVER, 1) for _ in range(transfers)]
+
+    start = time.perf_counter()
+    settle(ids)
+    elapsed = time.perf_counter() - start
+
+    rate = transfers / elapsed
+    print(f"{name:<12} {transfers:>7} transfers in {elapsed:8.3f}s  ->  {rate:10.1f} transfers/sec "
+          f"({concurrency} threads)")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transfers", type=int, default=1000, help="Transfers per run")
+    parser.add_argument("--concurrency", type=int, default=8, help="Threads settling transfers at once")
+    args = parser.parse_args()
+
+    database = SQLManager(pool_size=args.concurrency)
+    database.migrate()
+    setup_wallets(database)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+
+    def each(func):
+        return lambda ids: list(executor.map(lambda i: func(database, i, SENDER), ids))
+
+    try:
+        before = run("legacy", database, args.transfers, args.concurrency, each(legacy_confirm))
+        after = run("ledger", database, args.transfers, args.concurrency, each(SQLManager.confirm_transaction))
+        batch = run("batch", database, args.transfers, 1, database.settle_transactions)
+
+        print(f"\nLedger is {after / before:.1f}x the legacy path, batch is {batch / before:.1f}x")
+    finally:
+        cleanup(database)
+        executor.shutdown()
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
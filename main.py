@@ -1,33 +1,80 @@
+import time
+
+_startup_phases = {}  # Phase name -> seconds it took, printed once the bot is logged in
+_phase_start = time.perf_counter()
+
+
+def _end_phase(name: str):
+    """Records how long the startup phase that just finished took"""
+    global _phase_start
+    now = time.perf_counter()
+    _startup_phases[name] = now - _phase_start
+    _phase_start = now
+
+
+import asyncio
 import os
+import shutil
+import signal
+import tempfile
 from dotenv import load_dotenv
 
 import interactions
 from interactions import slash_command, SlashContext, OptionType, slash_option, listen, ModalContext, User, \
-    SlashCommandChoice
-from interactions import message_context_menu, ContextMenuContext, Message, Modal, ShortText
-from interactions.api.events import MessageCreate
-
-from SQLManager import SQLManager
+    SlashCommandChoice, AutocompleteContext
+from interactions import message_context_menu, ContextMenuContext, Message, Modal, ShortText, Embed
+from interactions.api.events import MessageCreate, GuildUpdate, GuildLeft, ChannelUpdate, ChannelDelete, \
+    MemberUpdate, GuildJoin
+
+from AsyncSQLManager import AsyncSQLManager
+from CategoryRegistry import CategoryRegistry
+from ComplaintIntake import ComplaintIntake, parse_channel_ids
+from EntityResolver import EntityResolver, USER, GUILD, CHANNEL
+import Exporter
+from InitiativeTracker import InitiativeTracker
+from NominationStats import NominationStats
+from Pager import Pager
+from QueryMetrics import serve_metrics
+import Schema
+from Sharding import SHARD_ID, SHARD_COUNT, owns
+from TransactionSweeper import TransactionSweeper
+from CommandTracer import traced, stage, tracing
 
 load_dotenv()
+_end_phase("imports")
 
-bot = interactions.Client(intents=interactions.Intents.ALL)
+# When run by Supervisor.py, this process only connects to its own shard and only sees that shard's guilds
+bot = interactions.Client(intents=interactions.Intents.ALL, shard_id=SHARD_ID, total_shards=SHARD_COUNT)
 
 # === GLOBALS ===
 # One day I'll integrate this into a place that uses less memory. Today is not that day, and neither is tomorrow
-database = SQLManager()  # Database connection
+database = AsyncSQLManager()  # Database connection pool. Doesn't connect until the first query
 # categories = ["Worst Idea", "Best Idea", "Biggest Lie", "Worst Bit", "Best Bit", "Least Funny Recurring Joke",
 #               "Craziest Working Gaslight", "Funniest Recurring Joke", "Dumbest Discussion"]
 _VERSION = "3.2.9"
-
-categories = database.get_categories()
-categories = [c[0] for c in categories]
-print("Found categories: ", categories)
-
-# Options for the nominations command
-choices_nominations = []
-for categoryName in categories:
-    choices_nominations.append(SlashCommandChoice(name=categoryName, value=categoryName))
+_NOMINATIONS_PER_PAGE = 5
+# Columns the nomination listings show (plus the ID, to find the next page)
+_LISTING_FIELDS = ("nominationID", "guildID", "channelID", "authorID", "category", "message")
+
+resolver = EntityResolver(bot, concurrency=int(os.getenv("RESOLVER_CONCURRENCY", 8)))  # Cached ID -> name lookups
+tracker = InitiativeTracker(database, resolver)  # Initiative rolls for every channel's encounter
+# Cancels transfers nobody confirmed or cancelled and gives the favors back
+sweeper = TransactionSweeper(database, max_age=float(os.getenv("TRANSACTION_MAX_AGE_HOURS", 24)) * 3600,
+                             interval=float(os.getenv("TRANSACTION_SWEEP_MINUTES", 10)) * 60,
+                             batch_size=int(os.getenv("TRANSACTION_SWEEP_BATCH", 200)))
+# Files messages posted in the HR channels (HR_CHANNEL_IDS, comma separated, or the older single HR_CHANNEL_ID)
+complaints = ComplaintIntake(database, parse_channel_ids(os.getenv("HR_CHANNEL_IDS", os.getenv("HR_CHANNEL_ID"))),
+                             max_pending=int(os.getenv("COMPLAINT_QUEUE_SIZE", 1000)))
+
+# Award categories, reloaded from the database every CATEGORY_RELOAD_SECONDS so new ones show up without a restart.
+# Until the first reload, they come from the snapshot the last one left on disk.
+categories = CategoryRegistry(snapshot_path=os.getenv("CATEGORY_SNAPSHOT_PATH", "categories.json"))
+nomination_stats = NominationStats()  # Per-guild nomination counts and leaderboards, loaded once the bot is up
+if categories.load_snapshot():
+    print("Found categories: ", list(categories))
+else:
+    print("No category snapshot yet, categories will be loaded from the database once the bot is up")
+_end_phase("setup")
 
 
 # === EVENTS ===
@@ -35,10 +82,113 @@ for categoryName in categories:
 
 @listen()
 async def on_startup():
+    _end_phase("gateway")
     print(f"Bot Version {_VERSION}, Interactions Library version {interactions.__version__}")
-    print(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    print(f"Logged in as {bot.user} (ID: {bot.user.id}), shard {SHARD_ID + 1} of {SHARD_COUNT}")
+    print("Startup took " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in _startup_phases.items()) +
+          f" ({sum(_startup_phases.values()) * 1000:.0f}ms total)")
     print("------\n")
 
+    # Anything that needs the database happens in the background, so an outage doesn't hold anything else up
+    asyncio.create_task(start_database())
+    try:
+        # The supervisor stops shards with SIGTERM
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(stop_bot()))
+    except NotImplementedError:
+        pass  # Not supported on Windows. Ctrl+C still works.
+    if os.getenv("METRICS_PORT"):
+        await serve_metrics(lambda: database.metrics.render(
+            {f"sql_pool_{k}": v for k, v in {**database.stats(), **database.health()}.items()
+             if isinstance(v, (int, float))}),
+            port=int(os.getenv("METRICS_PORT")) + SHARD_ID)  # Every shard gets its own port
+
+
+async def start_database():
+    """Brings the schema up to date once, then starts everything that loads from the database"""
+    if os.getenv("SQL_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes"):
+        try:
+            await database.migrate()
+        except Exception as e:
+            # The bot keeps going on the schema the database has. `python Schema.py` can be run by hand to finish.
+            print(f"Error migrating the database: {e}")
+
+    asyncio.create_task(categories.auto_reload(lambda: database, int(os.getenv("CATEGORY_RELOAD_SECONDS", 60))))
+    asyncio.create_task(restore_encounters())
+    asyncio.create_task(load_nomination_stats())
+    asyncio.create_task(warm_nomination_filter())
+    if owns(None):  # Transactions aren't tied to a guild, so the shard that gets DMs sweeps for all of them
+        asyncio.create_task(sweeper.run())
+
+
+async def restore_encounters():
+    try:
+        print(f"Restored {await tracker.load(SHARD_ID, SHARD_COUNT)} initiative encounters")
+    except Exception as e:
+        print(f"Error restoring initiative encounters: {e}")
+
+
+async def load_nomination_stats():
+    """Counts the nominations, retrying with backoff until the database can be reached"""
+    delay = 5
+    while True:
+        try:
+            print(f"Counted {await nomination_stats.load(database, SHARD_ID, SHARD_COUNT)} nominations")
+            return
+        except Exception as e:
+            print(f"Error counting nominations, retrying in {delay}s: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 300)
+
+
+async def warm_nomination_filter():
+    try:
+        print(f"Loaded {await database.warm_nomination_filter(SHARD_ID, SHARD_COUNT)} nominations into the "
+              f"duplicate filter")
+    except Exception as e:
+        print(f"Error loading the duplicate nomination filter: {e}")
+
+
+# Renames make the cached names stale, so drop them as soon as Discord tells us about it
+@listen(GuildUpdate)
+async def on_guild_update(event: GuildUpdate):
+    resolver.invalidate(GUILD, event.after.id)
+
+
+@listen(GuildLeft)
+async def on_guild_left(event: GuildLeft):
+    resolver.invalidate(GUILD, event.guild_id)
+
+
+@listen(ChannelUpdate)
+async def on_channel_update(event: ChannelUpdate):
+    resolver.invalidate(CHANNEL, event.after.id)
+
+
+@listen(ChannelDelete)
+async def on_channel_delete(event: ChannelDelete):
+    resolver.invalidate(CHANNEL, event.channel.id)
+
+
+@listen(MemberUpdate)
+async def on_member_update(event: MemberUpdate):
+    resolver.invalidate(USER, event.after.id)
+    if event.before is None or event.before.username != event.after.username:
+        await database.updateUser(event.after)
+
+
+@listen(GuildJoin)
+async def on_guild_join(event: GuildJoin):
+    """Saves every member of a guild once its member list is in (this also runs for each guild at startup)"""
+    guild = event.guild
+    if not guild.chunked.is_set():
+        await guild.chunk()  # Asks the gateway for the member list, which arrives in chunks
+
+    written = await database.sync_users(guild.members)
+    if written < 0:
+        print(f"Error: couldn't sync the members of {guild.name}")
+    elif written > 0:
+        print(f"Synced {written} new or renamed members of {guild.name}")
+
 
 # === COMMANDS ===
 
@@ -47,6 +197,7 @@ async def on_startup():
     name="ping",
     description="Ping the bot to see if it's alive."
 )
+@traced()
 async def ping(ctx: SlashContext):
     await ctx.send("Pong!")
 
@@ -55,6 +206,7 @@ async def ping(ctx: SlashContext):
     name="about",
     description="General information about the bot",
 )
+@traced(ephemeral=True)
 async def about(ctx: SlashContext):
     await ctx.send(f"Created by Connor Midgley.\n"
                    "Source code available at https://github.com/GameMagma/NewNakamoto \n"
@@ -74,13 +226,16 @@ async def about(ctx: SlashContext):
     description="Tests the database connection.",
     scopes=[os.getenv("TEST_GUILD_ID")]
 )
+@traced()
 async def dbtest(ctx: SlashContext):
-    await ctx.send(database.get_wallet(ctx.author.id)[1])
+    await ctx.send((await database.get_wallet(ctx.author.id)).cryptofavors)
 
 
 @slash_command(
     name="nominations",
-    description="View the current nominations"
+    description="Nominations for The Orwell Awards",
+    sub_cmd_name="list",
+    sub_cmd_description="View the current nominations"
 )
 @slash_option(
     name="nominator",
@@ -93,71 +248,207 @@ async def dbtest(ctx: SlashContext):
     description="The category to view nominations for",
     required=False,
     opt_type=OptionType.STRING,
-    choices=choices_nominations
+    autocomplete=True
 )
+@traced()
 async def get_nominations(ctx: SlashContext, nominator: User = None, category: str = None):
-    result = database.get_nomination(nominator, category)
+    if category is not None:
+        category = categories.lookup(category) or category  # Match the database's spelling if it's a real category
+
+    async def fetch(after_id):
+        # Grab one extra row to find out whether there's another page after this one
+        rows = await database.get_nomination(nominator, category, after_id=after_id, limit=_NOMINATIONS_PER_PAGE + 1,
+                                             fields=_LISTING_FIELDS)
+        if len(rows) > _NOMINATIONS_PER_PAGE:
+            rows = rows[:_NOMINATIONS_PER_PAGE]
+            return rows, rows[-1].nominationID
+        return rows, None
+
+    pager = Pager(ctx, fetch, render_nominations)
+    if not await pager.start():
+        await ctx.send("No nominations found.")
+
+
+async def render_nominations(nominations: list, page: int) -> Embed:
+    """
+    Formats a page of nominations.
+    :param nominations: Nominations, with at least the fields in _LISTING_FIELDS
+    :param page: Page number, starting at 1
+    """
+    # Look up every guild and channel on the page at once. Each unique ID costs at most one API call, and names stay
+    # cached between commands.
+    _, guilds, channels = await resolver.resolve_many(guilds=[n.guildID for n in nominations],
+                                                      channels=[n.channelID for n in nominations])
+
+    with stage("render"):
+        embed = Embed(title="Nominations")
+        for nomination in nominations:
+            author = f"<@{nomination.authorID}>"  # Convert to mention. Discord fills in the name, so no lookup needed
+            guild = guilds[int(nomination.guildID)]
+            channel = channels[int(nomination.channelID)]
+
+            embed.add_field(name=nomination.category,
+                            value=f"{nomination.message or '*No text*'}\n"  # Message (up to 255 characters)
+                                  f"Author: {author}\n"
+                                  f"Guild: {guild}\n"
+                                  f"Channel: {channel}",
+                            inline=False)
+
+        embed.set_footer(text=f"Page {page}")
+        return embed
+
+
+@slash_command(
+    name="nominations",
+    description="Nominations for The Orwell Awards",
+    sub_cmd_name="search",
+    sub_cmd_description="Search the text of nominated messages"
+)
+@slash_option(
+    name="text",
+    description="Words to look for. Messages with more of them come first.",
+    required=True,
+    opt_type=OptionType.STRING,
+)
+@slash_option(
+    name="nominator",
+    description="The user that nominated the message",
+    required=False,
+    opt_type=OptionType.USER,
+)
+@slash_option(
+    name="category",
+    description="The category to search in",
+    required=False,
+    opt_type=OptionType.STRING,
+    autocomplete=True
+)
+@slash_option(
+    name="channel",
+    description="The channel the message was sent in",
+    required=False,
+    opt_type=OptionType.CHANNEL,
+)
+@traced()
+async def search_nominations(ctx: SlashContext, text: str, nominator: User = None, category: str = None,
+                             channel: interactions.GuildChannel = None):
+    if category is not None:
+        category = categories.lookup(category) or category
+
+    async def fetch(offset):
+        # Results are ranked rather than in ID order, so pages are found by how many results came before them
+        offset = offset or 0
+        rows = await database.search_nominations(text, nominator, category, channel_id=channel.id if channel else None,
+                                                 offset=offset, limit=_NOMINATIONS_PER_PAGE + 1)
+        if len(rows) > _NOMINATIONS_PER_PAGE:
+            return rows[:_NOMINATIONS_PER_PAGE], offset + _NOMINATIONS_PER_PAGE
+        return rows, None
+
+    pager = Pager(ctx, fetch, render_nominations)
+    if not await pager.start():
+        await ctx.send("No nominations found.")
+
+
+@slash_command(
+    name="nominations",
+    description="Nominations for The Orwell Awards",
+    sub_cmd_name="stats",
+    sub_cmd_description="Shows how many nominations each category has in this server"
+)
+@traced()
+async def nominations_stats(ctx: SlashContext):
+    if ctx.guild_id is None:
+        await ctx.send("Nominations are counted per server, so this only works in one.", ephemeral=True)
+        return
+    if not nomination_stats.ready:
+        await ctx.send("Still counting nominations, try again in a bit.", ephemeral=True)
+        return
 
-    if result is None:
+    counts = nomination_stats.category_counts(ctx.guild_id)
+    if not counts:
         await ctx.send("No nominations found.")
+        return
+
+    with stage("render"):
+        embed = Embed(title="Nominations by Category",
+                      description="\n".join(f"**{category}:** {count}" for category, count in counts))
+        embed.set_footer(text=f"{nomination_stats.total(ctx.guild_id)} nominations in total")
+    await ctx.send(embeds=embed)
+
+
+@slash_command(
+    name="nominations",
+    description="Nominations for The Orwell Awards",
+    sub_cmd_name="top",
+    sub_cmd_description="Shows the most nominated messages, or the people who nominate the most"
+)
+@slash_option(
+    name="ranking",
+    description="What to rank",
+    required=True,
+    opt_type=OptionType.STRING,
+    choices=[
+        SlashCommandChoice(name="Messages", value="messages"),
+        SlashCommandChoice(name="Nominators", value="nominators"),
+    ]
+)
+@slash_option(
+    name="category",
+    description="Only count nominations for this category",
+    required=False,
+    opt_type=OptionType.STRING,
+    autocomplete=True
+)
+@slash_option(
+    name="count",
+    description="How many to show (10 by default)",
+    required=False,
+    opt_type=OptionType.INTEGER,
+    min_value=1,
+    max_value=25
+)
+@traced()
+async def nominations_top(ctx: SlashContext, ranking: str, category: str = None, count: int = 10):
+    if ctx.guild_id is None:
+        await ctx.send("Nominations are counted per server, so this only works in one.", ephemeral=True)
+        return
+    if not nomination_stats.ready:
+        await ctx.send("Still counting nominations, try again in a bit.", ephemeral=True)
+        return
+    if category is not None:
+        category = categories.lookup(category) or category
+
+    if ranking == "messages":
+        top = nomination_stats.top_messages(ctx.guild_id, count, category)
+        lines = [f"{place}. https://discord.com/channels/{ctx.guild_id}/{channelID}/{messageID} - {n}"
+                 for place, ((channelID, messageID), n) in enumerate(top, start=1)]
+        title = "Most Nominated Messages"
     else:
-        # Send result and make it look nice.
-        # Format: [(NominationID, GuildID, ChannelID, MessageID, AuthorID, Category, message), ...]
-        msg = "Nominations:\n"
-
-        print("Formatting")
-
-        for nomination in result:
-            # "get_user"/channel/guild only grabs from the cache. "fetch" actually polls the API for it (if
-            # it's not in the cache)
-            author: str
-            guild: str
-            channel: str
-
-            try:
-                authorRoutine = await bot.fetch_user(nomination[4])
-                author = f"<@{authorRoutine.id}>"  # Convert to mention
-            except AttributeError as user_not_found:
-                print(f"Error: An user wasn't found when trying to display nominations. "
-                      f"Full error: {user_not_found}")
-                author = nomination[4]
-
-            try:
-                guildRoutine = await bot.fetch_guild(nomination[1])
-                guild = guildRoutine.name
-            except AttributeError as guild_not_found:
-                print(f"Error: A guild wasn't found when trying to display nominations. "
-                      f"Full error: {guild_not_found}")
-                guild = nomination[1]
-
-            try:
-                channelRoutine = await bot.fetch_channel(nomination[2])
-                channel = channelRoutine.name
-            except AttributeError as channel_not_found:
-                print(f"Error: A channel wasn't found when trying to display nominations. "
-                      f"Full error: {channel_not_found}")
-                channel = nomination[2]
-
-            msg += f"Message (up to 255 characters): {nomination[6]}\n" \
-                   f"Category: {nomination[5]}\n" \
-                   f"Author: {author}\n" \
-                   f"Guild: {guild}\n" \
-                   f"Channel: {channel}\n\n"
-
-            await ctx.send(msg)
+        top = nomination_stats.top_nominators(ctx.guild_id, count, category)
+        lines = [f"{place}. <@{authorID}> - {n}" for place, (authorID, n) in enumerate(top, start=1)]
+        title = "Top Nominators"
+
+    if not lines:
+        await ctx.send("No nominations found.")
+        return
+
+    with stage("render"):
+        embed = Embed(title=title if category is None else f"{title}: {category}", description="\n".join(lines))
+    await ctx.send(embeds=embed)
+
+
+# Every command with a category option completes it the same way
+@get_nominations.autocomplete("category")
+@search_nominations.autocomplete("category")
+@nominations_top.autocomplete("category")
+async def category_autocomplete(ctx: AutocompleteContext):
+    await ctx.send(choices=[{"name": name, "value": name} for name in categories.complete(ctx.input_text)])
 
 
 @listen(MessageCreate)
 async def on_message_create(event: MessageCreate):
-    if event.message.channel.id == int(os.getenv("HR_CHANNEL_ID")):
-        await event.message.author.send("Thank you for the complaint, it has been filed and will be addressed in a "
-                                        "timely manner. Your input means very much to us. You can see the list of "
-                                        "complaints [here](https://docs.google.com/document/d"
-                                        "/1wjBOPLrslvETZ3WA2r3dwANrnwkd8oWlAthVFlhQ6cg/edit?usp=sharing)"
-                                        " (updates automatically).")
-        print("Complaint received")
-        await event.message.delete()
-
+    if complaints.watches(event.message.channel.id):
+        await complaints.submit(event.message)  # Acknowledged, saved and deleted in the background
 
 
 # === CONTEXT MENU COMMANDS ===
@@ -165,6 +456,7 @@ async def on_message_create(event: MessageCreate):
     name="repeat",
     scopes=[os.getenv("TEST_GUILD_ID")]
 )
+@traced()
 async def repeat(ctx: ContextMenuContext):
     msg: Message = ctx.target
     await ctx.send(f"You said: {msg.content}")
@@ -188,27 +480,44 @@ async def nominate(ctx: ContextMenuContext):
         title="Nominate",
         custom_id="category_selection"
     )
-    await ctx.send_modal(modal=category_selection)  # Send a modal that collects the category to nominate
+    # The command is over once the modal is up. However long the user takes to fill it in isn't the bot's time.
+    async with tracing("nominate", ctx):
+        await ctx.send_modal(modal=category_selection)  # Send a modal that collects the category to nominate
 
     # Wait for modal response, then retrieve
     modal_ctx: ModalContext = await ctx.bot.wait_for_modal(category_selection)
+    async with tracing("nominate_submit", modal_ctx):  # The modal submission has its own 3 second deadline
+        await _file_nomination(ctx, modal_ctx, msg)
+
 
+async def _file_nomination(ctx: ContextMenuContext, modal_ctx: ModalContext, msg: Message):
+    """Saves the nomination picked in the modal, and answers the modal submission"""
     # Extract responses
-    category = modal_ctx.responses["category"].title()
+    response = modal_ctx.responses["category"]
 
-    # Check to make sure category exists
-    if category.lower() not in [cat.lower() for cat in categories]:
-        await modal_ctx.send(f"{category} is an invalid category. Please try again.", ephemeral=True)
+    # Check to make sure category exists, and use its name as it's spelled in the database
+    category = categories.lookup(response)
+    if category is None:
+        await modal_ctx.send(f"{response.title()} is an invalid category. Please try again.", ephemeral=True)
         return
 
     # Send the category to the SQL database
-    successful = database.add_nomination(ctx.author.id, ctx.guild.id, ctx.channel.id, category, msg.id, msg.content)
+    successful = await database.add_nomination(ctx.author.id, ctx.guild.id, ctx.channel.id, category, msg.id,
+                                               msg.content)
+    if successful == -1:
+        with stage("send"):
+            await modal_ctx.send(f"That message is already nominated for {category}.", ephemeral=True)
+        return
     # await modal_ctx.send(str(database.get_nomination()))  # Debugging
 
     if successful:
-        await modal_ctx.send(f"Nomination for {category} added successfully.", reply_to=msg.id)
-    else:
-        await modal_ctx.send("The database had an error. Please let me know about this.", ephemeral=True)
+        nomination_stats.record(ctx.guild.id, ctx.channel.id, msg.id, ctx.author.id, category)
+
+    with stage("send"):
+        if successful:
+            await modal_ctx.send(f"Nomination for {category} added successfully.", reply_to=msg.id)
+        else:
+            await modal_ctx.send("The database had an error. Please let me know about this.", ephemeral=True)
 
 
 # === INITIATIVE COMMANDS ===
@@ -219,8 +528,9 @@ async def nominate(ctx: ContextMenuContext):
     sub_cmd_name="clear",
     sub_cmd_description="Clear the initiative list"
 )
+@traced()
 async def initiative_clear(ctx: SlashContext):
-    globals().get("roll_list").clear()
+    tracker.clear(ctx.guild_id, ctx.channel_id)
     await ctx.send("Roll list cleared.")
 
 
@@ -242,13 +552,14 @@ async def initiative_clear(ctx: SlashContext):
     required=False,
     opt_type=OptionType.STRING
 )
+@traced()
 async def initiative_roll(ctx: SlashContext, roll_result: int, name: str = None):
-    # Add roll to the roll list
+    # Add roll to this channel's encounter
     if name is None:
-        set_roll(ctx.author.id, roll_result)
+        tracker.set_roll(ctx.guild_id, ctx.channel_id, ctx.author.id, roll_result)
         await ctx.send(f"Roll of {roll_result} added.")
     else:  # If a name was specified, use that instead of the user's name
-        set_roll(name, roll_result)
+        tracker.set_roll(ctx.guild_id, ctx.channel_id, name, roll_result)
         await ctx.send(f"Roll of {roll_result} added for {name}.")
 
 
@@ -258,8 +569,9 @@ async def initiative_roll(ctx: SlashContext, roll_result: int, name: str = None)
     sub_cmd_name="get_order",
     sub_cmd_description="Displays the roll order for the current encounter."
 )
+@traced()
 async def initiative_get_order(ctx: SlashContext):
-    rolls = get_roll_list()
+    rolls = await tracker.get_order(ctx.guild_id, ctx.channel_id)
     if len(rolls) == 0:
         await ctx.send("No rolls have been submitted yet.")
     else:
@@ -269,48 +581,154 @@ async def initiative_get_order(ctx: SlashContext):
         await ctx.send(msg)
 
 
-# A global all the way down here? Isn't that bad practice? Yes. Yes it is.
-roll_list = {}  # List of rolls for the current encounter
+# === Admin ===
+@slash_command(
+    name="admin",
+    description="Commands for the bot administrator",
+    scopes=[os.getenv("TEST_GUILD_ID")],
+    sub_cmd_name="close_connection",
+    sub_cmd_description="Closes connection to the database"
+)
+@traced()
+async def admin_close_connection(ctx: SlashContext):
+    await database.shutdown()
+    await ctx.send("Connection to the database closed.")
 
 
-def get_roll(userID: int):
-    return roll_list.get(userID)
+@slash_command(
+    name="admin",
+    description="Commands for the bot administrator",
+    scopes=[os.getenv("TEST_GUILD_ID")],
+    sub_cmd_name="reload_categories",
+    sub_cmd_description="Reloads the award categories from the database"
+)
+@traced(ephemeral=True)
+async def admin_reload_categories(ctx: SlashContext):
+    if await categories.reload(database):
+        await ctx.send(f"Reloaded {len(categories)} categories.", ephemeral=True)
+    else:
+        await ctx.send("Couldn't reach the database. The old categories are still in use.", ephemeral=True)
 
 
-def get_roll_list():
-    """
-    :return: The full roll list, sorted. For players, their names will be converted into their native nicknames. For
-    NPC's, their names will be returned as is.
-    """
-    # For each loop - for each key in the roll list, if it's a discord ID (18-digit int), convert it to a nickname.
-    # If it's a string, leave it as is.
-    sorted_rolls = sorted(roll_list.items(), key=lambda x: x[1], reverse=True)
-    for i, (key, value) in enumerate(sorted_rolls):
-        if isinstance(key, int):
-            sorted_rolls[i] = (bot.get_user(key).display_name, value)
-    return sorted_rolls
+@slash_command(
+    name="admin",
+    description="Commands for the bot administrator",
+    scopes=[os.getenv("TEST_GUILD_ID")],
+    sub_cmd_name="stats",
+    sub_cmd_description="Shows which database queries are taking the most time"
+)
+@traced(ephemeral=True)
+async def admin_stats(ctx: SlashContext):
+    summary = database.metrics.summary(top=8)
+    pool = database.stats()
+
+    msg = f"**Pool:** {pool['in_use']}/{pool['size']} in use, {pool['checkouts']} checkouts, " \
+          f"avg wait {pool['avg_wait'] * 1000:.1f}ms, max wait {pool['max_wait'] * 1000:.1f}ms\n" \
+          f"**Commits:** {summary['commits']}, avg {summary['commit_avg_ms']:.1f}ms\n" \
+          f"**Wallet cache:** {pool['wallet_cache_size']} wallets, {pool['wallet_cache_hits']} hits, " \
+          f"{pool['wallet_cache_misses']} misses\n" \
+          f"**Sweeper:** {sweeper.cancelled} stale transactions cancelled, {sweeper.refunded} favors refunded\n" \
+          f"**Complaints:** {complaints.saved} filed, {complaints.pending} queued, {complaints.failed} failed\n" \
+          f"**Slow queries:** {summary['slow_queries']}\n\n"
+    for s in summary["statements"]:
+        line = f"`{s['statement'][:120]}`\n{s['count']} runs, {s['total_ms']:.0f}ms total, " \
+               f"avg {s['avg_ms']:.1f}ms, max {s['max_ms']:.1f}ms, {s['rows']} rows\n"
+        if len(msg) + len(line) > 2000:  # Discord's message limit
+            break
+        msg += line
+    await ctx.send(msg, ephemeral=True)
 
 
-def set_roll(characterID: int | str, die_result: int) -> None:
-    """
-    Set the roll for the given user.
-    :param characterID: 18-digit integer for the user's discord ID. If the roll is for an NPC, it will be a string.
-    :param die_result: Number that was rolled
-    """
-    roll_list.update({characterID: die_result})
+@slash_command(
+    name="admin",
+    description="Commands for the bot administrator",
+    scopes=[os.getenv("TEST_GUILD_ID")],
+    sub_cmd_name="export",
+    sub_cmd_description="Exports a table as a gzipped file"
+)
+@slash_option(
+    name="table",
+    description="Table to export",
+    required=True,
+    opt_type=OptionType.STRING,
+    choices=[SlashCommandChoice(name=table.title(), value=table) for table in Exporter.EXPORTABLE_TABLES]
+)
+@slash_option(
+    name="format",
+    description="File format (CSV by default)",
+    required=False,
+    opt_type=OptionType.STRING,
+    choices=[SlashCommandChoice(name="CSV", value="csv"), SlashCommandChoice(name="JSON Lines", value="jsonl")]
+)
+@traced(ephemeral=True)
+async def admin_export(ctx: SlashContext, table: str, format: str = "csv"):
+    if ctx.author_id != 456269883873951744:  # Exports include balances and every complaint
+        await ctx.send("You do not have permission to use this command.", ephemeral=True)
+        return
+
+    name = Exporter.file_name(table, format)
+    upload_limit = int(float(os.getenv("EXPORT_UPLOAD_LIMIT_MB", 10)) * 1024 * 1024)  # Discord's attachment limit
+
+    # Small exports stay in memory, bigger ones spill over to disk
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as file:
+        rows = await database.run(Exporter.export, database.sync, table, format, file)
+        size = file.tell()
+        file.seek(0)
+
+        if size <= upload_limit:
+            with stage("send"):
+                await ctx.send(f"Exported {rows} rows from {table}.", file=interactions.File(file, file_name=name),
+                               ephemeral=True)
+            return
+
+        # Too big to upload, so it goes in the export folder instead
+        path = os.path.join(os.getenv("EXPORT_DIR", "exports"), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as output:
+            await asyncio.to_thread(shutil.copyfileobj, file, output)
+    await ctx.send(f"Exported {rows} rows from {table}. That's {size / 1024 / 1024:.1f}MB, too big to upload, "
+                   f"so it was saved to `{path}` on the bot's server.", ephemeral=True)
 
 
-# === Admin ===
 @slash_command(
     name="admin",
     description="Commands for the bot administrator",
     scopes=[os.getenv("TEST_GUILD_ID")],
-    sub_cmd_name="close_connection",
-    sub_cmd_description="Closes connection to the database"
+    sub_cmd_name="health",
+    sub_cmd_description="Shows whether the database can be reached"
 )
-async def admin_close_connection(ctx: SlashContext):
-    database.close()
-    await ctx.send("Connection to the database closed.")
+@traced(ephemeral=True)
+async def admin_health(ctx: SlashContext):
+    health = database.health()
+    msg = f"**Database ({health['backend']}):** {'healthy' if health['healthy'] else 'unreachable'}\n" \
+          f"Dead connections replaced: {health['dead_connections']} (reconnects: {health['reconnects']})\n"
+    if health["last_error"] is not None:
+        msg += f"Last error: `{health['last_error'][:300]}`\n"
+    if health["consecutive_failures"]:
+        msg += f"Failed connection attempts in a row: {health['consecutive_failures']}\n"
+    await ctx.send(msg, ephemeral=True)
+
+
+@slash_command(
+    name="admin",
+    description="Commands for the bot administrator",
+    scopes=[os.getenv("TEST_GUILD_ID")],
+    sub_cmd_name="plans",
+    sub_cmd_description="Lists database queries that read a whole table"
+)
+@traced(ephemeral=True)
+async def admin_plans(ctx: SlashContext):
+    scans = await database.run(Schema.check_plans, database.sync)
+    version = await database.schema_version()
+    msg = f"**Schema version:** {version} of {Schema.LATEST}\n"
+    if not scans:
+        msg += "No query the bot has run so far scans a whole table."
+    for statement, tables in scans:
+        line = f"Scans {', '.join(tables)}: `{statement[:200]}`\n"
+        if len(msg) + len(line) > 2000:  # Discord's message limit
+            break
+        msg += line
+    await ctx.send(msg, ephemeral=True)
 
 
 # Command to restart the connection to the database. Check if it's closed already. If so, close it. Finally,
@@ -322,11 +740,15 @@ async def admin_close_connection(ctx: SlashContext):
     sub_cmd_name="restart_connection",
     sub_cmd_description="Restarts the connection to the database"
 )
+@traced()
 async def admin_restart_connection(ctx: SlashContext):
-    if database.is_closed():
-        database.close()
+    if not database.is_closed():
+        await database.shutdown()
 
-    globals()['database'] = SQLManager()  # Reset the database connection
+    globals()['database'] = AsyncSQLManager()  # Reset the database connection
+    tracker.database = database
+    sweeper.database = database
+    complaints.database = database
 
     await ctx.send("Connection to the database restarted.")
 
@@ -343,6 +765,7 @@ async def admin_restart_connection(ctx: SlashContext):
     required=True,
     opt_type=OptionType.STRING
 )
+@traced()
 async def admin_say(ctx: SlashContext, message: str):
     if ctx.author_id == 456269883873951744:
         await ctx.send("Repeating:", ephemeral=True)
@@ -388,6 +811,7 @@ async def admin_say(ctx: SlashContext, message: str):
     required=False,
     opt_type=OptionType.STRING
 )
+@traced()
 async def status_set(ctx: SlashContext, status: str, activity_type: str = None, activity: str = None):
     if ctx.author_id == 456269883873951744:
         if status == "online":
@@ -425,15 +849,25 @@ async def status_set(ctx: SlashContext, status: str, activity_type: str = None,
     sub_cmd_name="shutdown",
     sub_cmd_description="Shuts down the bot."
 )
+@traced()
 async def shutdown(ctx: SlashContext):
     if ctx.author_id == 456269883873951744:
         print("Asked to shut down. Goodbye.")
         await ctx.send("Shutting down.")
-        if not database.is_closed():
-            database.close()
-        await bot.stop()
+        await stop_bot()
     else:
         await ctx.send("You do not have permission to use this command.", ephemeral=True)
 
 
-bot.start(os.getenv("DISCORD_TOKEN"))
+async def stop_bot():
+    """Saves everything that's still waiting to be written, then logs out"""
+    await tracker.flush()  # Save any initiative changes that are still waiting
+    await complaints.close()  # File any complaints that are still queued
+    if not database.is_closed():
+        await database.shutdown()  # Flushes any queued writes first
+    await bot.stop()
+
+
+if __name__ == "__main__":
+    _end_phase("commands")
+    bot.start(os.getenv("DISCORD_TOKEN"))